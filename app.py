@@ -4,22 +4,38 @@ from datetime import datetime
 import os
 import json
 import traceback
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.prompts import PromptTemplate
-from langchain.schema import StrOutputParser
 from dotenv import load_dotenv
-# New imports for web search functionality
-from duckduckgo_search import DDGS  # Updated to use DDGS class directly
+# The Gemini clients, Chroma, DuckDuckGo search, BeautifulSoup and the text splitter are
+# imported where they are first used, so the server can answer health checks right away
 import time  # For implementing backoff/retry
 import random  # For jittering retry times
-from langchain_core.runnables import RunnablePassthrough
-from langchain_community.document_loaders import WebBaseLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_chroma import Chroma
-from urllib.parse import urlparse
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from typing import List
+import requests  # For fetching pages with conditional headers
+from requests.adapters import HTTPAdapter
+import socket  # For caching DNS lookups
+import sqlite3  # For the on-disk page cache
+import hashlib  # For content-derived chunk IDs
+from array import array  # For compact vector storage
+from collections import OrderedDict  # For LRU caches
+import contextlib
+from contextlib import contextmanager
+import re  # For normalizing question text
+import numpy as np  # For similarity scoring
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+from typing import List, TYPE_CHECKING
 import logging
+import threading  # For per-stage concurrency limits
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+import queue  # For relaying progress from worker threads
+import asyncio  # For the async query pipeline used by asgi.py
+if TYPE_CHECKING:
+    # langchain_core takes most of the import time of app.py, so its types are only imported for type checkers
+    from langchain_core.documents import Document
+    from langchain_core.embeddings import Embeddings
+try:
+    import fcntl  # For running vectorstore maintenance in one process only
+except ImportError:  # Windows
+    fcntl = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -28,26 +44,1935 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
+# Startup settings
+EAGER_INIT = os.getenv('EAGER_INIT', 'true').lower() == 'true'  # Build the models in the background at startup, not on the first request
+
+# Concurrency limits and deadline for the web search pipeline
+SEARCH_CONCURRENCY = int(os.getenv('SEARCH_CONCURRENCY', 3))  # Parallel DuckDuckGo searches
+FETCH_CONCURRENCY = int(os.getenv('FETCH_CONCURRENCY', 8))  # Parallel page downloads
+PIPELINE_CONCURRENCY = int(os.getenv('PIPELINE_CONCURRENCY', 32))  # Search questions being searched, loaded and indexed at once
+QUERY_DEADLINE_SECONDS = float(os.getenv('QUERY_DEADLINE_SECONDS', 30))  # Total budget for searching and loading
+SPECULATIVE_START = os.getenv('SPECULATIVE_START', 'false').lower() == 'true'  # Start searching while the LLM router decides
+SPECULATION_CONCURRENCY = int(os.getenv('SPECULATION_CONCURRENCY', 8))  # Parallel speculative search question generations
+
+# Search scheduler settings, shared by every request in the process
+SEARCH_RATE_PER_SECOND = float(os.getenv('SEARCH_RATE_PER_SECOND', 1.0))  # Sustained DuckDuckGo queries per second
+SEARCH_BURST = int(os.getenv('SEARCH_BURST', 5))  # Queries allowed back to back before the rate applies
+SEARCH_CACHE_TTL = float(os.getenv('SEARCH_CACHE_TTL', 3600))  # Seconds to reuse results for the same query
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', 2000))
+
+# Page content cache settings
+PAGE_CACHE_PATH = os.getenv('PAGE_CACHE_PATH', './page_cache.sqlite3')
+PAGE_CACHE_TTL_SECONDS = float(os.getenv('PAGE_CACHE_TTL_SECONDS', 6 * 3600))
+PAGE_CACHE_MAX_BYTES = int(os.getenv('PAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+PAGE_FETCH_TIMEOUT = float(os.getenv('PAGE_FETCH_TIMEOUT', 10))  # Seconds per page download
+PAGE_MAX_BYTES = int(os.getenv('PAGE_MAX_BYTES', 2 * 1024 * 1024))  # Larger pages are truncated
+PAGES_IN_FLIGHT = int(os.getenv('PAGES_IN_FLIGHT', 4))  # Pages per search question downloading or waiting to be indexed
+HTML_CONTENT_TYPES = ("text/html", "application/xhtml+xml")
+PAGE_FETCH_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.5",
+}
+
+# Shared HTTP client settings
+HTTP_POOL_HOSTS = int(os.getenv('HTTP_POOL_HOSTS', 100))  # Hosts whose idle connections are kept open
+HTTP_POOL_PER_HOST = int(os.getenv('HTTP_POOL_PER_HOST', 4))  # Concurrent connections to any one host
+DNS_CACHE_TTL = float(os.getenv('DNS_CACHE_TTL', 60))  # Seconds to reuse a DNS answer whatever its record TTL, 0 disables the cache
+
+# Embedding cache settings
+EMBEDDING_MODEL = "models/embedding-001"
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', './embedding_cache.sqlite3')
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv('EMBEDDING_CACHE_MAX_BYTES', 256 * 1024 * 1024))  # Least recently used vectors beyond this are dropped
+CACHE_ACCESS_RESOLUTION = 3600  # Seconds; an entry's last use is only rewritten when older than this
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 100))  # Texts per embedding request (API maximum is 100)
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv('QUERY_EMBEDDING_CACHE_SIZE', 1024))
+INDEX_BATCH_SIZE = int(os.getenv('INDEX_BATCH_SIZE', EMBEDDING_BATCH_SIZE))  # Chunks embedded and inserted together as pages arrive
+
+# Vectorstore retention and compaction settings
+VECTORSTORE_PATH = os.getenv('VECTORSTORE_PATH', './web_chroma_db')
+VECTORSTORE_COLLECTION = "langchain"
+VECTORSTORE_RETENTION_DAYS = float(os.getenv('VECTORSTORE_RETENTION_DAYS', 30))  # Drop chunks not seen for this long
+VECTORSTORE_MAX_CHUNKS = int(os.getenv('VECTORSTORE_MAX_CHUNKS', 200000))  # Oldest chunks beyond this are dropped
+VECTORSTORE_COMPACT_RATIO = float(os.getenv('VECTORSTORE_COMPACT_RATIO', 0.2))  # Rebuild once deletions reach this share
+VECTORSTORE_MAINTENANCE_INTERVAL = float(os.getenv('VECTORSTORE_MAINTENANCE_INTERVAL', 3600))  # Seconds
+VECTORSTORE_BATCH_SIZE = 5000  # Records per Chroma get/add/delete call during maintenance
+VECTORSTORE_BACKEND = os.getenv('VECTORSTORE_BACKEND', 'chroma')  # 'chroma', or 'quantized' for the int8 index
+QUANTIZED_INDEX_PATH = os.getenv('QUANTIZED_INDEX_PATH', './vector_index')
+QUANTIZED_RESCORE = os.getenv('QUANTIZED_RESCORE', 'true').lower() == 'true'  # Re-score top candidates with float32 vectors
+QUANTIZED_RESCORE_FACTOR = int(os.getenv('QUANTIZED_RESCORE_FACTOR', 4))  # Candidates re-scored per result
+
+# Page chunking settings
+CHUNK_SIZE = 1000  # Characters per chunk
+CHUNK_OVERLAP = 200  # Characters repeated between neighbouring chunks
+
+# Search question generation settings
+SEARCH_QUESTIONS_MAX = int(os.getenv('SEARCH_QUESTIONS_MAX', 5))  # Search questions kept per question
+SEARCH_QUESTIONS_DUPLICATE_SIMILARITY = float(os.getenv('SEARCH_QUESTIONS_DUPLICATE_SIMILARITY', 0.9))  # Word overlap that counts as a duplicate
+SEARCH_QUESTIONS_CACHE_SIZE = int(os.getenv('SEARCH_QUESTIONS_CACHE_SIZE', 2000))
+SEARCH_QUESTIONS_CACHE_TTL = float(os.getenv('SEARCH_QUESTIONS_CACHE_TTL', 24 * 3600))
+
+# Retrieval settings
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 1500))  # Context tokens given to the answer prompt
+RETRIEVAL_CANDIDATES = int(os.getenv('RETRIEVAL_CANDIDATES', 20))  # Chunks fetched per query before reranking
+RETRIEVAL_MMR_LAMBDA = float(os.getenv('RETRIEVAL_MMR_LAMBDA', 0.7))  # 1 ranks by relevance only, lower favours diversity
+RETRIEVAL_TIMEOUT = float(os.getenv('RETRIEVAL_TIMEOUT', 3))  # Seconds for embedding the queries and searching the index
+RETRIEVAL_CONCURRENCY = int(os.getenv('RETRIEVAL_CONCURRENCY', 8))  # Parallel query embeddings and index lookups
+
+# Background prefetch settings
+QUERY_LOG_PATH = os.getenv('QUERY_LOG_PATH', './query_log.sqlite3')
+PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', 'false').lower() == 'true'  # Keep hot questions warm in the background
+PREFETCH_INTERVAL = float(os.getenv('PREFETCH_INTERVAL', 300))  # Seconds between prefetch rounds
+PREFETCH_QUESTIONS = int(os.getenv('PREFETCH_QUESTIONS', 20))  # Hottest questions warmed per round
+PREFETCH_WINDOW_SECONDS = float(os.getenv('PREFETCH_WINDOW_SECONDS', 24 * 3600))  # Only questions asked this recently
+PREFETCH_REFRESH_SECONDS = float(os.getenv('PREFETCH_REFRESH_SECONDS', 1800))  # Warm each question at most this often
+PREFETCH_CONCURRENCY = int(os.getenv('PREFETCH_CONCURRENCY', 2))  # Parallel page downloads for prefetching
+PREFETCH_RATE_PER_SECOND = float(os.getenv('PREFETCH_RATE_PER_SECOND', 0.2))  # Searches per second for prefetching
+
+# Answer cache settings
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', 1000))
+ANSWER_CACHE_WEB_TTL = float(os.getenv('ANSWER_CACHE_WEB_TTL', 3600))  # Web answers go stale quickly
+ANSWER_CACHE_STANDARD_TTL = float(os.getenv('ANSWER_CACHE_STANDARD_TTL', 24 * 3600))
+ANSWER_CACHE_SEMANTIC = os.getenv('ANSWER_CACHE_SEMANTIC', 'false').lower() == 'true'  # Match near-duplicate questions
+ANSWER_CACHE_SIMILARITY = float(os.getenv('ANSWER_CACHE_SIMILARITY', 0.95))  # Cosine similarity needed for a match
+
+# Web search routing settings
+ROUTER_CONFIDENCE_THRESHOLD = float(os.getenv('ROUTER_CONFIDENCE_THRESHOLD', 0.7))  # Below this, ask the LLM
+ROUTER_MEMO_SIZE = int(os.getenv('ROUTER_MEMO_SIZE', 10000))
+
+def normalize_url(url: str) -> str:
+    """Normalize a URL so equivalent links share one cache entry"""
+    parsed = urlparse(url.strip())
+    scheme = parsed.scheme.lower() or "http"
+    host = (parsed.hostname or "").lower()
+    
+    # Drop default ports
+    port = parsed.port
+    if port and not ((scheme == "http" and port == 80) or (scheme == "https" and port == 443)):
+        host = f"{host}:{port}"
+    
+    # Drop tracking parameters and sort the rest so ordering doesn't matter
+    params = [
+        (key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+        if not key.lower().startswith("utm_")
+    ]
+    query = urlencode(sorted(params))
+    
+    # Fragments never change the page content
+    return urlunparse((scheme, host, parsed.path or "/", "", query, ""))
+
+
+def open_cache_db(path: str) -> sqlite3.Connection:
+    """Open a sqlite cache file that several worker processes may read and write at once"""
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")  # Readers don't block the writer, nor the writer them
+    return conn
+
+
+class PageCache:
+    """On-disk cache of extracted page text keyed by normalized URL, with TTL and LRU eviction"""
+    def __init__(self, path: str, ttl_seconds: float, max_bytes: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()  # One connection shared by the fetch workers
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        
+        self.conn = open_cache_db(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                metadata TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                size INTEGER NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS pages_last_access ON pages (last_access)")
+        self.conn.commit()
+
+    def get(self, url: str, refresh_ahead: float = 0):
+        """Return the cached entry for a URL (fresh or stale) or None.
+
+        Entries expiring within refresh_ahead seconds are reported as stale.
+        """
+        key = normalize_url(url)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT text, metadata, etag, last_modified, fetched_at, last_access FROM pages WHERE url = ?",
+                (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            
+            text, metadata, etag, last_modified, fetched_at, last_access = row
+            fresh = now - fetched_at < self.ttl_seconds - refresh_ahead
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1  # Stale entries still need a round trip to revalidate
+            
+            # Eviction only needs a rough order, so most reads don't write at all
+            if now - last_access > CACHE_ACCESS_RESOLUTION:
+                self.conn.execute("UPDATE pages SET last_access = ? WHERE url = ?", (now, key))
+                self.conn.commit()
+        
+        return {
+            "text": text,
+            "metadata": json.loads(metadata),
+            "etag": etag,
+            "last_modified": last_modified,
+            "fresh": fresh
+        }
+
+    def put(self, url: str, text: str, metadata: dict, etag: str = None, last_modified: str = None):
+        """Store extracted page text and evict least recently used pages over the size limit"""
+        key = normalize_url(url)
+        now = time.time()
+        size = len(text.encode("utf-8"))
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, text, json.dumps(metadata), etag, last_modified, now, now, size)
+            )
+            self._evict()
+            self.conn.commit()
+
+    def mark_revalidated(self, url: str):
+        """Restart the TTL of an entry the origin confirmed is unchanged (HTTP 304)"""
+        now = time.time()
+        with self.lock:
+            self.revalidations += 1
+            self.hits += 1
+            self.misses -= 1  # The stale lookup turned out to be a hit
+            self.conn.execute(
+                "UPDATE pages SET fetched_at = ?, last_access = ? WHERE url = ?",
+                (now, now, normalize_url(url))
+            )
+            self.conn.commit()
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        
+        for url, size in self.conn.execute("SELECT url, size FROM pages ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            self.conn.execute("DELETE FROM pages WHERE url = ?", (url,))
+            total -= size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and current cache size"""
+        with self.lock:
+            entries, total = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages"
+            ).fetchone()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "evictions": self.evictions,
+                "entries": entries,
+                "bytes": total
+            }
+
+
+class DNSCache:
+    """TTL cache in front of socket.getaddrinfo, so repeat hosts skip the DNS lookup"""
+    def __init__(self, ttl: float, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (host, port, ...) -> (expires_at, addresses)
+        self.lock = threading.Lock()
+        self.resolve = socket.getaddrinfo
+        self.installed = False
+        self.hits = 0
+        self.misses = 0
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        key = (host, port, family, type, proto, flags)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        
+        # Failed lookups raise and are never cached
+        addresses = self.resolve(host, port, family, type, proto, flags)
+        with self.lock:
+            self.entries[key] = (now + self.ttl, addresses)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return addresses
+
+    def install(self):
+        """Route every lookup in the process through the cache, including the search client's.
+
+        Called when the server builds its components, never on import, so other importers of
+        app.py keep the plain resolver.
+        """
+        with self.lock:
+            if self.installed:
+                return
+            self.resolve = socket.getaddrinfo
+            socket.getaddrinfo = self.getaddrinfo
+            self.installed = True
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+
+
+dns_cache = DNSCache(DNS_CACHE_TTL)  # Installed by ensure_components
+
+
+def create_http_session() -> requests.Session:
+    """Create an HTTP session that keeps connections alive and pools them per host"""
+    session = requests.Session()
+    # Blocking pools cap the open connections to any one host at HTTP_POOL_PER_HOST
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_HOSTS,
+        pool_maxsize=HTTP_POOL_PER_HOST,
+        pool_block=True,
+        max_retries=0
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(PAGE_FETCH_HEADERS)
+    return session
+
+
+class SharedLock:
+    """Lock held by many threads in shared mode or by one thread in exclusive mode"""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = False
+
+    @contextmanager
+    def shared(self):
+        with self.condition:
+            while self.writer:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self.condition:
+            while self.writer:
+                self.condition.wait()
+            self.writer = True  # Stop new shared holders while we wait for current ones
+            while self.readers:
+                self.condition.wait()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+
+@contextmanager
+def process_lock(path: str):
+    """Hold an exclusive lock on a file shared by all processes, waiting until it is free.
+
+    Without fcntl (on Windows) the lock is a no-op.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a") as handle:
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        yield
+
+
+class RequestTimings:
+    """Seconds spent in each stage of one request; stages that run per sub-query are summed"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def add(self, stage: str, seconds: float):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return {stage: round(seconds, 4) for stage, seconds in self.stages.items()}
+
+
+class Metrics:
+    """Minimal Prometheus-style registry of counters and latency histograms"""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> {"buckets": [...], "sum": float, "count": int}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                key, {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0}
+            )
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    @contextmanager
+    def span(self, stage: str, timings: RequestTimings = None):
+        """Time a pipeline stage into the stage histogram and, if given, the request's timings"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe("stage_duration_seconds", elapsed, stage=stage)
+            if timings is not None:
+                timings.add(stage, elapsed)
+
+    def render(self, collected: List = ()) -> str:
+        """Render all metrics in the Prometheus text format.
+
+        collected holds (name, type, labels, value) samples read from elsewhere at scrape time,
+        such as the counters the caches keep themselves.
+        """
+        def series(name, labels, suffix=""):
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+            return f"{self.prefix}_{name}{suffix}" + (f"{{{label_text}}}" if label_text else "")
+        
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {self.prefix}_{name} counter")
+                for (metric, labels), value in sorted(self.counters.items()):
+                    if metric == name:
+                        lines.append(f"{series(name, labels)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {self.prefix}_{name} histogram")
+                for (metric, labels), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(self.BUCKETS, histogram["buckets"]):
+                        lines.append(f"{series(name, labels + (('le', bound),), '_bucket')} {count}")
+                    lines.append(f"{series(name, labels + (('le', '+Inf'),), '_bucket')} {histogram['count']}")
+                    lines.append(f"{series(name, labels, '_sum')} {histogram['sum']}")
+                    lines.append(f"{series(name, labels, '_count')} {histogram['count']}")
+        
+        for name, kind in sorted({(name, kind) for name, kind, _, _ in collected}):
+            lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+            for metric, _, labels, value in collected:
+                if metric == name:
+                    lines.append(f"{series(name, tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics("research_navigator")
+
+
+def chunk_id(text: str) -> str:
+    """Stable vectorstore ID for a chunk, derived from its content"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def document_id(doc: "Document") -> str:
+    """Stable vectorstore ID for a chunk of a page, derived from its source and content"""
+    return chunk_id(f"{doc.metadata.get('source', '')}\n{doc.page_content}")
+
+
+class CachedEmbeddings:
+    """Embeddings wrapper that batches requests, caches document vectors on disk and memoizes queries.
+
+    Implements the embed_documents/embed_query interface of langchain's Embeddings without
+    subclassing it, which keeps importing app.py fast.
+    """
+    def __init__(self, embeddings: "Embeddings", model: str, path: str, batch_size: int, query_cache_size: int,
+                 max_bytes: int):
+        self.embeddings = embeddings
+        self.model = model
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.query_cache_size = query_cache_size
+        self.query_cache = OrderedDict()  # LRU of query text -> vector
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.query_hits = 0
+        self.query_misses = 0
+        self.api_calls = 0
+        self.evictions = 0
+        
+        self.conn = open_cache_db(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                size INTEGER NOT NULL DEFAULT 0,
+                last_access REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (model, text_hash)
+            )
+        """)
+        # Caches created before the size limit lack the LRU columns
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(embeddings)")}
+        if "size" not in columns:
+            self.conn.execute("ALTER TABLE embeddings ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+            self.conn.execute("ALTER TABLE embeddings ADD COLUMN last_access REAL NOT NULL DEFAULT 0")
+            self.conn.execute("UPDATE embeddings SET size = length(vector)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)")
+        self.conn.commit()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed documents, only sending texts without a cached vector to the model"""
+        hashes = [chunk_id(text) for text in texts]
+        vectors = {}
+        
+        now = time.time()
+        with self.lock:
+            touched = []
+            for text_hash in set(hashes):
+                row = self.conn.execute(
+                    "SELECT vector, last_access FROM embeddings WHERE model = ? AND text_hash = ?",
+                    (self.model, text_hash)
+                ).fetchone()
+                if row:
+                    vectors[text_hash] = array('f', row[0]).tolist()
+                    if now - row[1] > CACHE_ACCESS_RESOLUTION:
+                        touched.append((now, self.model, text_hash))
+            # Recency only needs to be roughly right for eviction, so most hits write nothing
+            if touched:
+                self.conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE model = ? AND text_hash = ?", touched
+                )
+                self.conn.commit()
+        
+        # Embed each distinct missing text once, in batches the API accepts
+        missing = {}
+        for text, text_hash in zip(texts, hashes):
+            if text_hash not in vectors:
+                missing.setdefault(text_hash, text)
+        missing_hashes = list(missing)
+        
+        for start in range(0, len(missing_hashes), self.batch_size):
+            batch = missing_hashes[start:start + self.batch_size]
+            batch_vectors = self.embeddings.embed_documents([missing[text_hash] for text_hash in batch])
+            with self.lock:
+                self.api_calls += 1
+                blobs = [array('f', vector).tobytes() for vector in batch_vectors]
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                    [(self.model, text_hash, blob, len(blob), now) for text_hash, blob in zip(batch, blobs)]
+                )
+                self._evict()
+                self.conn.commit()
+            vectors.update(zip(batch, batch_vectors))
+        
+        with self.lock:
+            self.misses += len(missing_hashes)
+            self.hits += len(texts) - len(missing_hashes)
+        
+        return [list(vectors[text_hash]) for text_hash in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a search query, reusing recent results"""
+        with self.lock:
+            if text in self.query_cache:
+                self.query_cache.move_to_end(text)
+                self.query_hits += 1
+                return list(self.query_cache[text])
+            self.query_misses += 1
+        
+        vector = self.embeddings.embed_query(text)
+        
+        with self.lock:
+            self.api_calls += 1
+            self.query_cache[text] = vector
+            self.query_cache.move_to_end(text)
+            while len(self.query_cache) > self.query_cache_size:
+                self.query_cache.popitem(last=False)
+        return list(vector)
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        
+        # Free a tenth of the limit beyond what is needed, so the next inserts don't evict again
+        target = self.max_bytes * 0.9
+        doomed = []
+        for rowid, size in self.conn.execute("SELECT rowid, size FROM embeddings ORDER BY last_access"):
+            if total <= target:
+                break
+            doomed.append((rowid,))
+            total -= size
+        self.conn.executemany("DELETE FROM embeddings WHERE rowid = ?", doomed)
+        self.evictions += len(doomed)
+
+    def stats(self) -> dict:
+        """Return cache counters and the number of calls made to the embedding model"""
+        with self.lock:
+            return {
+                "model": self.model,
+                "hits": self.hits,
+                "misses": self.misses,
+                "query_hits": self.query_hits,
+                "query_misses": self.query_misses,
+                "api_calls": self.api_calls,
+                "evictions": self.evictions
+            }
+
+
+class ChromaVectorStore:
+    """Vector backend on a persistent Chroma collection.
+
+    Compaction builds a new collection under a fresh name. The name in use is recorded in an
+    active_collection file in the persist directory, so a restart reopens whichever one is live.
+    """
+    def __init__(self, embeddings: "Embeddings", path: str, collection_name: str):
+        self.embeddings = embeddings
+        self.path = path
+        self.collection_name = collection_name
+        self.store = self._open(self._active_name())
+
+    def _pointer_path(self) -> str:
+        return os.path.join(self.path, "active_collection")
+
+    def _active_name(self) -> str:
+        try:
+            with open(self._pointer_path()) as f:
+                return f.read().strip() or self.collection_name
+        except FileNotFoundError:
+            return self.collection_name
+
+    def _set_active_name(self, name: str):
+        # Written aside and renamed, so the pointer is never half-written
+        os.makedirs(self.path, exist_ok=True)
+        scratch = self._pointer_path() + ".tmp"
+        with open(scratch, "w") as f:
+            f.write(name)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(scratch, self._pointer_path())
+
+    def _open(self, collection_name: str):
+        from langchain_chroma import Chroma
+        return Chroma(
+            collection_name=collection_name,
+            embedding_function=self.embeddings,
+            persist_directory=self.path
+        )
+
+    def existing_ids(self, ids: List[str]) -> List[str]:
+        return self.store.get(ids=ids, include=[])["ids"]
+
+    def update_metadata(self, ids: List[str], metadatas: List[dict]):
+        self.store._collection.update(ids=ids, metadatas=metadatas)
+
+    def upsert(self, ids: List[str], vectors: List[List[float]], texts: List[str], metadatas: List[dict]):
+        self.store._collection.upsert(ids=ids, embeddings=vectors, documents=texts, metadatas=metadatas)
+
+    def all_metadata(self):
+        """Return (ids, metadatas) of every stored chunk"""
+        data = self.store.get(include=["metadatas"])
+        return data["ids"], data["metadatas"]
+
+    def delete(self, ids: List[str]):
+        self.store.delete(ids=ids)
+
+    def compact(self, switch=contextlib.nullcontext):
+        """Rebuild the collection so the HNSW index only holds live chunks.
+
+        The live chunks are copied into a new collection while requests keep using the current one.
+        Only the catch-up of chunks added or deleted meanwhile and the switch to the new collection
+        run inside switch(). A crash at any point leaves the active collection untouched; the
+        leftover copy is dropped by the next compaction.
+        """
+        self._drop_orphans()
+        name = f"{self.collection_name}_{time.time_ns()}"
+        target = self._open(name)
+        self._copy(self.store, target)
+        with switch():
+            self._catch_up(self.store, target)
+            self._set_active_name(name)
+            previous, self.store = self.store, target
+        previous.delete_collection()
+
+    def _drop_orphans(self):
+        """Delete collections left behind by compactions that did not finish"""
+        active = self._active_name()
+        leftover = re.compile(rf"{re.escape(self.collection_name)}(_\d+|_compact)?")
+        for collection in self.store._client.list_collections():
+            name = getattr(collection, "name", collection)
+            if name != active and leftover.fullmatch(name):
+                logger.info(f"Dropping leftover collection {name}")
+                self.store._client.delete_collection(name)
+
+    def _catch_up(self, source, target):
+        """Apply the additions and deletions made to source since it was copied into target"""
+        source_ids = set(source.get(include=[])["ids"])
+        target_ids = set(target.get(include=[])["ids"])
+        added = list(source_ids - target_ids)
+        removed = list(target_ids - source_ids)
+        for start in range(0, len(added), VECTORSTORE_BATCH_SIZE):
+            self._add_page(target, source.get(
+                ids=added[start:start + VECTORSTORE_BATCH_SIZE], include=["embeddings", "documents", "metadatas"]
+            ))
+        for start in range(0, len(removed), VECTORSTORE_BATCH_SIZE):
+            target.delete(ids=removed[start:start + VECTORSTORE_BATCH_SIZE])
+
+    def _copy(self, source, target):
+        offset = 0
+        while True:
+            page = source.get(
+                include=["embeddings", "documents", "metadatas"],
+                limit=VECTORSTORE_BATCH_SIZE,
+                offset=offset
+            )
+            if not page["ids"]:
+                break
+            self._add_page(target, page)
+            offset += len(page["ids"])
+
+    @staticmethod
+    def _add_page(target, page):
+        target._collection.add(
+            ids=page["ids"],
+            embeddings=page["embeddings"],
+            documents=page["documents"],
+            metadatas=page["metadatas"]
+        )
+
+    def query(self, query_vectors, n_results: int, sources: List[str]):
+        """Top chunks of the given sources for each query vector, as lists of (id, document, vector)"""
+        from langchain_core.documents import Document
+        results = self.store._collection.query(
+            query_embeddings=query_vectors,
+            n_results=n_results,
+            where={"source": {"$in": sources}},
+            include=["documents", "metadatas", "embeddings"]
+        )
+        return [
+            [
+                (id, Document(page_content=text, metadata=metadata or {}), vector)
+                for id, text, metadata, vector in zip(ids, texts, metadatas, vectors)
+            ]
+            for ids, texts, metadatas, vectors in zip(
+                results["ids"], results["documents"], results["metadatas"], results["embeddings"]
+            )
+        ]
+
+
+class QuantizedVectorStore:
+    """Vector backend keeping unit vectors in memory-mapped int8 files, with chunk metadata in sqlite.
+
+    The vector files are append-only and mapped read-only, so every worker process shares one copy
+    through the OS page cache. Queries only score the chunks of the requested sources: int8 dot
+    products first, then with rescore an exact float32 re-score of the best candidates.
+    Compaction writes a new generation of files, so readers in other processes never see rows
+    renumbered under them.
+    """
+    def __init__(self, path: str, rescore: bool, rescore_factor: int):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.rescore = rescore  # Also keeps float32 copies on disk, only read for the top candidates
+        self.rescore_factor = rescore_factor  # Candidates re-scored per requested result
+        self.maps = {}  # (generation, kind) -> read-only memmap, remapped when the file grew
+        self.lock = threading.Lock()
+        
+        self.conn = sqlite3.connect(
+            os.path.join(path, "chunks.sqlite3"), check_same_thread=False, timeout=30, isolation_level=None
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS chunks (
+                id TEXT PRIMARY KEY,
+                row INTEGER NOT NULL,
+                source TEXT,
+                document TEXT NOT NULL,
+                metadata TEXT NOT NULL,
+                deleted INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS chunks_source ON chunks (source)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS header (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    @contextmanager
+    def _transaction(self, mode: str = "DEFERRED"):
+        # IMMEDIATE transactions serialize writers across processes
+        with self.lock:
+            self.conn.execute(f"BEGIN {mode}")
+            try:
+                yield
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def _header(self) -> dict:
+        header = dict(self.conn.execute("SELECT key, value FROM header").fetchall())
+        return {"generation": header.get("generation", 0), "dim": header.get("dim"), "rows": header.get("rows", 0)}
+
+    def _set_header(self, **values):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO header VALUES (?, ?)", [(key, value) for key, value in values.items()]
+        )
+
+    def _file(self, generation: int, kind: str) -> str:
+        return os.path.join(self.path, f"{kind}.{generation}")
+
+    def _write(self, generation: int, kind: str, rows, values: np.ndarray):
+        """Write one array row per index in rows, at its fixed offset in the file"""
+        fd = os.open(self._file(generation, kind), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            row_bytes = values[0].nbytes
+            for row, value in zip(rows, values):
+                os.pwrite(fd, value.tobytes(), row * row_bytes)
+        finally:
+            os.close(fd)
+
+    def _array(self, generation: int, kind: str, dtype, width: int, rows: int) -> np.ndarray:
+        """Read-only map of one vector file holding at least rows rows"""
+        key = (generation, kind)
+        array = self.maps.get(key)
+        if array is None or array.shape[0] < rows:
+            array = np.memmap(self._file(generation, kind), dtype=dtype, mode="r", shape=(rows, width))
+            self.maps[key] = array
+        return array
+
+    @staticmethod
+    def _quantize(vectors):
+        unit = np.asarray(vectors, dtype=np.float32)
+        unit = unit / np.maximum(np.linalg.norm(unit, axis=1, keepdims=True), 1e-12)
+        scales = np.maximum(np.abs(unit).max(axis=1), 1e-12) / 127
+        codes = np.round(unit / scales[:, None]).astype(np.int8)
+        return unit, codes, scales.astype(np.float32)
+
+    def existing_ids(self, ids: List[str]) -> List[str]:
+        found = []
+        with self.lock:
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                found += [id for (id,) in self.conn.execute(
+                    f"SELECT id FROM chunks WHERE deleted = 0 AND id IN ({','.join('?' * len(batch))})", batch
+                )]
+        return found
+
+    def update_metadata(self, ids: List[str], metadatas: List[dict]):
+        with self._transaction("IMMEDIATE"):
+            self.conn.executemany(
+                "UPDATE chunks SET metadata = ?, source = ? WHERE id = ?",
+                [(json.dumps(metadata), metadata.get("source"), id) for id, metadata in zip(ids, metadatas)]
+            )
+
+    def upsert(self, ids: List[str], vectors: List[List[float]], texts: List[str], metadatas: List[dict]):
+        unit, codes, scales = self._quantize(vectors)
+        with self._transaction("IMMEDIATE"):
+            header = self._header()
+            if header["dim"] is not None and header["dim"] != unit.shape[1]:
+                raise ValueError(f"Vector size {unit.shape[1]} does not match the index ({header['dim']})")
+            
+            # Replaced chunks keep their row; new chunks are appended
+            rows_by_id = {}
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                rows_by_id.update(self.conn.execute(
+                    f"SELECT id, row FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch
+                ).fetchall())
+            next_row = header["rows"]
+            rows = []
+            for id in ids:
+                if id not in rows_by_id:
+                    rows_by_id[id] = next_row
+                    next_row += 1
+                rows.append(rows_by_id[id])
+            
+            # Vectors go to disk before their rows become visible to readers
+            generation = header["generation"]
+            self._write(generation, "vectors.i8", rows, codes)
+            self._write(generation, "scales.f4", rows, scales[:, None])
+            if self.rescore:
+                self._write(generation, "vectors.f4", rows, unit)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, 0)",
+                [
+                    (id, row, metadata.get("source"), text, json.dumps(metadata))
+                    for id, row, text, metadata in zip(ids, rows, texts, metadatas)
+                ]
+            )
+            self._set_header(dim=unit.shape[1], rows=next_row)
+
+    def all_metadata(self):
+        """Return (ids, metadatas) of every stored chunk"""
+        with self.lock:
+            rows = self.conn.execute("SELECT id, metadata FROM chunks WHERE deleted = 0").fetchall()
+        return [id for id, _ in rows], [json.loads(metadata) for _, metadata in rows]
+
+    def delete(self, ids: List[str]):
+        # Rows stay in the vector files until the next compaction
+        with self._transaction("IMMEDIATE"):
+            self.conn.executemany("UPDATE chunks SET deleted = 1 WHERE id = ?", [(id,) for id in ids])
+
+    def compact(self, switch=contextlib.nullcontext):
+        """Write a new generation of vector files holding only live chunks.
+
+        The sqlite transaction is the switch here, so switch is not needed.
+        """
+        with self._transaction("IMMEDIATE"):
+            header = self._header()
+            live = self.conn.execute("SELECT id, row FROM chunks WHERE deleted = 0 ORDER BY row").fetchall()
+            old, new = header["generation"], header["generation"] + 1
+            if live:
+                rows = np.array([row for _, row in live])
+                dim = header["dim"]
+                kinds = [("vectors.i8", np.int8, dim), ("scales.f4", np.float32, 1)]
+                if self.rescore:
+                    kinds.append(("vectors.f4", np.float32, dim))
+                for kind, dtype, width in kinds:
+                    values = np.asarray(self._array(old, kind, dtype, width, header["rows"])[rows])
+                    self._write(new, kind, range(len(live)), values)
+            self.conn.execute("DELETE FROM chunks WHERE deleted = 1")
+            self.conn.executemany("UPDATE chunks SET row = ? WHERE id = ?", [(i, id) for i, (id, _) in enumerate(live)])
+            self._set_header(generation=new, rows=len(live))
+        
+        # Readers still on the previous generation may be mid-query; older ones are unused
+        for name in os.listdir(self.path):
+            generation = name.rsplit(".", 1)[-1]
+            if generation.isdigit() and int(generation) < old:
+                os.remove(os.path.join(self.path, name))
+        self.maps = {key: array for key, array in self.maps.items() if key[0] >= old}
+
+    def query(self, query_vectors, n_results: int, sources: List[str]):
+        """Top chunks of the given sources for each query vector, as lists of (id, document, vector)"""
+        from langchain_core.documents import Document
+        # Header and rows from one snapshot, so they match the generation of files we read
+        with self._transaction():
+            header = self._header()
+            candidates = self.conn.execute(
+                f"SELECT id, row, document, metadata FROM chunks WHERE deleted = 0 "
+                f"AND source IN ({','.join('?' * len(sources))})",
+                sources
+            ).fetchall()
+        if not candidates:
+            return [[] for _ in query_vectors]
+        
+        generation, dim, total = header["generation"], header["dim"], header["rows"]
+        rows = np.array([row for _, row, _, _ in candidates])
+        codes = np.asarray(self._array(generation, "vectors.i8", np.int8, dim, total)[rows], dtype=np.float32)
+        scales = np.asarray(self._array(generation, "scales.f4", np.float32, 1, total)[rows])
+        vectors = codes * scales
+        queries, _, _ = self._quantize(query_vectors)
+        scores = queries @ vectors.T
+        
+        exact_file = self._file(generation, "vectors.f4")
+        if self.rescore and os.path.exists(exact_file) and os.path.getsize(exact_file) >= total * dim * 4:
+            # Replace the approximate vectors of every query's best candidates with the exact ones
+            top = min(len(candidates), n_results * self.rescore_factor)
+            best = np.unique(np.argpartition(-scores, top - 1, axis=1)[:, :top])
+            exact = self._array(generation, "vectors.f4", np.float32, dim, total)
+            vectors[best] = exact[rows[best]]
+            scores[:, best] = queries @ vectors[best].T
+        
+        results = []
+        for query_scores in scores:
+            order = np.argsort(-query_scores)[:n_results]
+            results.append([
+                (
+                    candidates[i][0],
+                    Document(page_content=candidates[i][2], metadata=json.loads(candidates[i][3])),
+                    vectors[i]
+                )
+                for i in order
+            ])
+        return results
+
+
+def normalize_question(question: str) -> str:
+    """Normalize question text so trivially different phrasings share a cache key.
+
+    Only case, whitespace and trailing punctuation are ignored; symbols inside the text are kept,
+    since they often change the meaning ("C++" and "C#", "2+2" and "2-2").
+    """
+    return " ".join(question.lower().split()).rstrip("?!. ")
+
+
+class AnswerCache:
+    """LRU cache of final answers keyed by normalized question, with optional similarity matching"""
+    def __init__(self, max_entries: int, web_ttl: float, standard_ttl: float,
+                 embeddings: "Embeddings" = None, similarity_threshold: float = 0.95):
+        self.max_entries = max_entries
+        self.web_ttl = web_ttl
+        self.standard_ttl = standard_ttl
+        self.embeddings = embeddings  # Only set when near-duplicate matching is enabled
+        self.similarity_threshold = similarity_threshold
+        self.entries = OrderedDict()  # key -> {"answer", "web_search", "expires_at", "vector"}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def get(self, question: str):
+        """Return (entry, similarity) for a cached answer to this question, or (None, 0.0)"""
+        key = normalize_question(question)
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key], 1.0
+            if self.embeddings is None or not self.entries:
+                self.misses += 1
+                return None, 0.0
+        
+        # Look for a near-duplicate question
+        try:
+            vector = np.asarray(self.embeddings.embed_query(key), dtype=np.float32)
+            vector /= np.linalg.norm(vector) or 1.0
+        except Exception as e:
+            logger.error(f"Error embedding question for answer cache: {str(e)}")
+            with self.lock:
+                self.misses += 1
+            return None, 0.0
+        
+        with self.lock:
+            best_key, best_score = None, 0.0
+            for candidate, entry in self.entries.items():
+                if entry["vector"] is None:
+                    continue
+                score = float(np.dot(vector, entry["vector"]))
+                if score > best_score:
+                    best_key, best_score = candidate, score
+            if best_key is not None and best_score >= self.similarity_threshold:
+                self.entries.move_to_end(best_key)
+                self.hits += 1
+                self.semantic_hits += 1
+                return self.entries[best_key], best_score
+            self.misses += 1
+            return None, 0.0
+
+    def put(self, question: str, answer: str, web_search: bool):
+        """Cache an answer; web-backed answers expire sooner than model-only answers"""
+        key = normalize_question(question)
+        vector = None
+        if self.embeddings is not None:
+            try:
+                vector = np.asarray(self.embeddings.embed_query(key), dtype=np.float32)
+                vector /= np.linalg.norm(vector) or 1.0
+            except Exception as e:
+                logger.error(f"Error embedding question for answer cache: {str(e)}")
+        
+        ttl = self.web_ttl if web_search else self.standard_ttl
+        with self.lock:
+            self.entries[key] = {
+                "answer": answer,
+                "web_search": web_search,
+                "expires_at": time.time() + ttl,
+                "vector": vector
+            }
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _expire(self, now: float):
+        for key in [key for key, entry in self.entries.items() if entry["expires_at"] <= now]:
+            del self.entries[key]
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and the number of cached answers"""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "entries": len(self.entries)
+            }
+
+
+# Phrases that suggest the answer depends on current information
+RECENCY_PATTERNS = [
+    r"\b(latest|newest|recent|recently|current|currently|today|tonight|yesterday|tomorrow|now)\b",
+    r"\bthis (week|month|year|season|quarter)\b",
+    r"\b(news|headlines|breaking|announced|announcement|released|release date|launch(ed)?|update[sd]?)\b",
+    r"\b(price|prices|stock|stocks|share price|market cap|exchange rate|weather|forecast|score|scores|standings)\b",
+    r"\b(who won|who is winning|election|elected|ceo of|president of|prime minister of)\b",
+    r"\b(20[2-9]\d)\b",
+]
+
+# Phrases that suggest a timeless question the model can answer on its own
+TIMELESS_PATTERNS = [
+    r"^(what is|what are|what does|define|explain|describe)\b",
+    r"^(how (does|do|can|to)|why (does|do|is|are))\b",
+    r"\b(difference between|compare|pros and cons|meaning of|definition of)\b",
+    r"\b(prove|derive|derivation|calculate|solve|equation|theorem|formula)\b",
+    r"\b(write|rewrite|translate|summari[sz]e|paraphrase|code|function|algorithm)\b",
+    r"\b(history of|origin of|invented|discovered)\b",
+]
+
+
+# One item of a numbered or bulleted list, e.g. "1. query", "2) query" or "- query"
+LIST_ITEM_PATTERN = re.compile(r"^\s*(?:\d+\s*[.)]|[-*•])\s+(.+?)\s*$")
+
+
+def parse_search_questions(result: str) -> List[str]:
+    """Parse search questions from model output: a JSON array of strings, or a numbered list as fallback"""
+    # The first "[" that starts a valid array of strings wins, whatever prose or brackets follow it
+    decoder = json.JSONDecoder()
+    for match in re.finditer(r"\[", result):
+        try:
+            parsed, _ = decoder.raw_decode(result, match.start())
+        except ValueError:
+            continue
+        if isinstance(parsed, list):
+            questions = [" ".join(item.split()) for item in parsed if isinstance(item, str)]
+            if any(questions):
+                return [question for question in questions if question]
+    
+    questions = []
+    for line in result.splitlines():
+        item = LIST_ITEM_PATTERN.match(line)
+        if item:
+            question = item.group(1).strip("\"'*` ")
+            if question:
+                questions.append(question)
+    return questions
+
+
+def collapse_near_duplicates(questions: List[str], threshold: float) -> List[str]:
+    """Drop questions whose words mostly overlap those of a question kept earlier"""
+    kept, kept_words = [], []
+    for question in questions:
+        words = set(normalize_question(question).split())
+        if not words:
+            continue
+        if any(len(words & other) / len(words | other) >= threshold for other in kept_words):
+            logger.info(f"Dropping near-duplicate search question: {question}")
+            continue
+        kept.append(question)
+        kept_words.append(words)
+    return kept
+
+
+class SearchQuestionCache:
+    """LRU of generated search questions per normalized question, so repeated topics skip the LLM"""
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # normalized question -> (expires_at, search questions)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, question: str):
+        """Return the cached search questions for a question, or None"""
+        key = normalize_question(question)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return list(entry[1])
+            self.misses += 1
+            return None
+
+    def put(self, question: str, search_questions: List[str]):
+        key = normalize_question(question)
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, list(search_questions))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+
+
+def heuristic_web_search_classifier(question: str):
+    """Decide from keyword and recency cues whether a question needs a web search.
+
+    Returns (needs_web_search, confidence) with confidence between 0 and 1.
+    """
+    text = normalize_question(question)
+    recency = sum(1 for pattern in RECENCY_PATTERNS if re.search(pattern, text))
+    timeless = sum(1 for pattern in TIMELESS_PATTERNS if re.search(pattern, text))
+    
+    if recency == timeless:
+        return recency > 0, 0.5  # No cues, or conflicting ones
+    margin = abs(recency - timeless)
+    confidence = min(0.95, 0.6 + 0.15 * margin)
+    return recency > timeless, confidence
+
+
+class WebSearchRouter:
+    """Decides whether a question needs a web search, using a cheap classifier before the LLM"""
+    def __init__(self, classifier, fallback, confidence_threshold: float, memo_size: int, afallback=None):
+        self.classifier = classifier  # question -> (needs_web_search, confidence)
+        self.fallback = fallback  # question -> needs_web_search, only used when unsure
+        self.afallback = afallback  # Optional async version of fallback
+        self.confidence_threshold = confidence_threshold
+        self.memo_size = memo_size
+        self.memo = OrderedDict()  # LRU of normalized question -> decision
+        self.lock = threading.Lock()
+        self.decisions = 0
+        self.memo_hits = 0
+        self.fallbacks = 0
+        self.fallback_errors = 0  # Fallbacks that failed, so the classifier's guess was used unmemoized
+        self.total_seconds = 0.0
+
+    def decide(self, question: str, on_fallback=None) -> bool:
+        """Return True when the question should be answered with a web search.
+
+        on_fallback, if given, is called just before the slow LLM fallback is asked.
+        """
+        start = time.perf_counter()
+        key = normalize_question(question)
+        decision = self._lookup(key)
+        
+        used_fallback = failed = False
+        if decision is None:
+            decision, confident = self._classify(question)
+            if not confident:
+                used_fallback = True
+                if on_fallback:
+                    on_fallback()
+                try:
+                    decision = self.fallback(question)
+                except Exception as e:
+                    failed = True
+                    logger.error(f"Error in web search decision fallback: {str(e)}")
+        
+        self._record(key, decision, time.perf_counter() - start, used_fallback, failed)
+        return decision
+
+    async def adecide(self, question: str, on_fallback=None) -> bool:
+        """Async version of decide"""
+        start = time.perf_counter()
+        key = normalize_question(question)
+        decision = self._lookup(key)
+        
+        used_fallback = failed = False
+        if decision is None:
+            decision, confident = self._classify(question)
+            if not confident:
+                used_fallback = True
+                if on_fallback:
+                    on_fallback()
+                try:
+                    if self.afallback:
+                        decision = await self.afallback(question)
+                    else:
+                        decision = await asyncio.to_thread(self.fallback, question)
+                except Exception as e:
+                    failed = True
+                    logger.error(f"Error in web search decision fallback: {str(e)}")
+        
+        self._record(key, decision, time.perf_counter() - start, used_fallback, failed)
+        return decision
+
+    def _lookup(self, key: str):
+        with self.lock:
+            decision = self.memo.get(key)
+            if decision is not None:
+                self.memo.move_to_end(key)
+                self.memo_hits += 1
+            return decision
+
+    def _classify(self, question: str):
+        decision, confidence = self.classifier(question)
+        logger.info(f"Local router decision: {decision} (confidence {confidence:.2f})")
+        return decision, confidence >= self.confidence_threshold
+
+    def _record(self, key: str, decision: bool, elapsed: float, used_fallback: bool, failed: bool = False):
+        with self.lock:
+            self.decisions += 1
+            self.total_seconds += elapsed
+            if used_fallback:
+                self.fallbacks += 1
+            if failed:
+                # Don't memoize a low-confidence guess; the next ask goes to the LLM again
+                self.fallback_errors += 1
+                return
+            self.memo[key] = decision
+            self.memo.move_to_end(key)
+            while len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+
+    def stats(self) -> dict:
+        """Return routing latency and how often the LLM fallback was needed"""
+        with self.lock:
+            return {
+                "decisions": self.decisions,
+                "memo_hits": self.memo_hits,
+                "fallbacks": self.fallbacks,
+                "fallback_errors": self.fallback_errors,
+                "fallback_rate": self.fallbacks / self.decisions if self.decisions else 0.0,
+                "avg_latency_ms": 1000 * self.total_seconds / self.decisions if self.decisions else 0.0
+            }
+
+
+class TokenBucket:
+    """Token-bucket rate limiter shared by every thread that calls the search engine"""
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate  # Tokens added per second
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # Set after throttling so every caller backs off together
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline: float = None) -> bool:
+        """Wait for a token; returns False if none is available before the deadline"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait_time = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            
+            if deadline is not None and now + wait_time > deadline:
+                return False
+            time.sleep(wait_time)
+
+    def available(self) -> float:
+        """Tokens that could be handed out right now"""
+        with self.lock:
+            if time.monotonic() < self.blocked_until:
+                return 0.0
+            return min(self.capacity, self.tokens + (time.monotonic() - self.updated) * self.rate)
+
+    def penalize(self, seconds: float):
+        """Stop handing out tokens for a while, e.g. after the upstream throttled us"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class SearchScheduler:
+    """Shared search layer: result cache, rate limiting and coalescing of identical in-flight queries"""
+    def __init__(self, client, rate: float, burst: int, cache_ttl: float, cache_size: int, max_retries: int = 3):
+        self._client = client  # DDGS or anything with the same text() method; DDGS is created on first use
+        self.bucket = TokenBucket(rate, burst)
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.max_retries = max_retries
+        self.cache = OrderedDict()  # (normalized query, max results) -> (expires_at, results)
+        self.in_flight = {}  # (normalized query, max results) -> Future shared by all waiters
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.upstream_calls = 0
+
+    def search(self, query: str, max_results: int, deadline: float = None, refresh_ahead: float = 0) -> List[dict]:
+        """Return search results for a query, going upstream at most once for concurrent duplicates.
+
+        Cached results expiring within refresh_ahead seconds are fetched again.
+        """
+        key = (normalize_question(query), max_results)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry and entry[0] > time.time() + refresh_ahead:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return list(entry[1])
+            
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.in_flight[key] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        
+        if not leader:
+            logger.info(f"Joining in-flight search for: {query}")
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                return list(future.result(timeout=timeout))
+            except FuturesTimeoutError:
+                return []
+        
+        try:
+            results = self._fetch(query, max_results, deadline)
+            future.set_result(results)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+        
+        # Empty results are usually throttling, so only cache real answers
+        if results:
+            with self.lock:
+                self.cache[key] = (time.time() + self.cache_ttl, results)
+                self.cache.move_to_end(key)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return list(results)
+
+    def client(self):
+        """The search client, creating a DuckDuckGo one on first use"""
+        with self.lock:
+            if self._client is None:
+                from duckduckgo_search import DDGS
+                self._client = DDGS()
+            return self._client
+
+    def _fetch(self, query: str, max_results: int, deadline: float = None) -> List[dict]:
+        """Query the search engine through the rate limiter, backing off on failures"""
+        base_wait = 2  # seconds
+        
+        for attempt in range(self.max_retries):
+            if not self.bucket.acquire(deadline):
+                logger.warning(f"Search rate limit would exceed the deadline for: {query}")
+                return []
+            
+            try:
+                with self.lock:
+                    self.upstream_calls += 1
+                # Using the new DDGS().text() method instead of results()
+                search_results = self.client().text(
+                    query, 
+                    region='wt-wt',  # Worldwide results
+                    safesearch='Off', 
+                    max_results=max_results
+                )
+                
+                # Convert to list since text() returns a generator
+                search_results = list(search_results)
+                if search_results:
+                    return search_results
+                
+                logger.warning(f"Attempt {attempt+1}: No results returned from DuckDuckGo")
+            except Exception as e:
+                logger.error(f"Attempt {attempt+1}: DuckDuckGo search error: {str(e)}")
+            
+            if attempt < self.max_retries - 1:
+                # Back off through the shared bucket so concurrent requests slow down together
+                wait_time = base_wait * (2 ** attempt) + random.uniform(0, 1)  # Exponential backoff with jitter
+                logger.info(f"Backing off searches for {wait_time:.2f}s before retry...")
+                metrics.inc("search_retries_total")
+                self.bucket.penalize(wait_time)
+        
+        return []
+
+    def stats(self) -> dict:
+        """Return cache, coalescing and upstream call counters"""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "upstream_calls": self.upstream_calls,
+                "cached_queries": len(self.cache)
+            }
+
+
+class QueryLog:
+    """On-disk log of how often and how recently each web-searched question was asked"""
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = open_cache_db(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS queries (
+                key TEXT PRIMARY KEY,
+                question TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                last_asked REAL NOT NULL,
+                last_warmed REAL
+            )
+        """)
+        self.conn.commit()
+
+    def record(self, question: str):
+        """Count one more ask of a question"""
+        with self.lock:
+            self.conn.execute(
+                """
+                INSERT INTO queries (key, question, count, last_asked) VALUES (?, ?, 1, ?)
+                ON CONFLICT(key) DO UPDATE SET count = count + 1, question = excluded.question,
+                    last_asked = excluded.last_asked
+                """,
+                (normalize_question(question), question, time.time())
+            )
+            self.conn.commit()
+
+    def hot(self, limit: int, window_seconds: float, refresh_seconds: float) -> List[str]:
+        """Most asked questions of the window that haven't been warmed within refresh_seconds"""
+        now = time.time()
+        with self.lock:
+            # Questions nobody asked within the window are no longer worth keeping
+            self.conn.execute("DELETE FROM queries WHERE last_asked < ?", (now - window_seconds,))
+            self.conn.commit()
+            rows = self.conn.execute(
+                """
+                SELECT question FROM queries WHERE last_warmed IS NULL OR last_warmed < ?
+                ORDER BY count DESC, last_asked DESC LIMIT ?
+                """,
+                (now - refresh_seconds, limit)
+            ).fetchall()
+        return [question for (question,) in rows]
+
+    def mark_warmed(self, question: str):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE queries SET last_warmed = ? WHERE key = ?",
+                (time.time(), normalize_question(question))
+            )
+            self.conn.commit()
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries, asks = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(count), 0) FROM queries").fetchone()
+            return {"questions": entries, "asks": asks}
+
+
+class Prefetcher:
+    """Background worker that keeps the caches and vectorstore warm for frequently asked questions.
+
+    Runs the search half of the pipeline for the hottest questions in the query log on its own
+    fetch pool and search rate budget, and yields whenever live traffic is using the shared one.
+    """
+    def __init__(self, rag: "WebRAG", query_log: QueryLog):
+        self.rag = rag
+        self.query_log = query_log
+        self.executor = ThreadPoolExecutor(max_workers=PREFETCH_CONCURRENCY, thread_name_prefix="webrag-prefetch")
+        self.bucket = TokenBucket(PREFETCH_RATE_PER_SECOND, 1)
+        # Refresh whatever would expire before the question is warmed again
+        self.refresh_ahead = PREFETCH_REFRESH_SECONDS + PREFETCH_INTERVAL
+        self.lock = threading.Lock()
+        self.rounds = 0
+        self.questions_warmed = 0
+        self.searches = 0
+        self.deferred = 0
+
+    def start(self):
+        threading.Thread(target=self._loop, name="webrag-prefetch", daemon=True).start()
+
+    def _loop(self):
+        while True:
+            time.sleep(PREFETCH_INTERVAL)
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Error prefetching hot questions: {str(e)}")
+
+    def _live_traffic_idle(self) -> bool:
+        bucket = self.rag.searcher.bucket
+        return bucket.available() >= bucket.capacity / 2
+
+    def run_once(self) -> int:
+        """Warm the hottest questions that are due, returning how many were warmed"""
+        warmed = 0
+        for question in self.query_log.hot(PREFETCH_QUESTIONS, PREFETCH_WINDOW_SECONDS, PREFETCH_REFRESH_SECONDS):
+            if not self._live_traffic_idle():
+                logger.info("Deferring prefetch, live traffic is using the search budget")
+                with self.lock:
+                    self.deferred += 1
+                break
+            self.warm(question)
+            warmed += 1
+        
+        with self.lock:
+            self.rounds += 1
+            self.questions_warmed += warmed
+        return warmed
+
+    def warm(self, question: str):
+        """Generate the search questions for a question, then search, load and index their pages"""
+        logger.info(f"Prefetching: {question}")
+        deadline = time.monotonic() + QUERY_DEADLINE_SECONDS
+        for search_question in self.rag.generate_search_questions(question):
+            if not self.bucket.acquire(deadline):
+                break
+            self.rag._search_and_load(
+                search_question, deadline=deadline, executor=self.executor, refresh_ahead=self.refresh_ahead
+            )
+            with self.lock:
+                self.searches += 1
+        self.query_log.mark_warmed(question)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(
+                self.query_log.stats(),
+                enabled=PREFETCH_ENABLED,
+                rounds=self.rounds,
+                questions_warmed=self.questions_warmed,
+                searches=self.searches,
+                deferred=self.deferred
+            )
+
+
+def page_metadata(soup, url: str) -> dict:
+    """Build document metadata the same way WebBaseLoader does"""
+    metadata = {"source": url}
+    if soup.find("title"):
+        metadata["title"] = soup.find("title").get_text()
+    description = soup.find("meta", attrs={"name": "description"})
+    if description:
+        metadata["description"] = description.get("content", "No description found.")
+    html = soup.find("html")
+    if html:
+        metadata["language"] = html.get("lang", "No language found.")
+    return metadata
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of a text, about four characters per token"""
+    return len(text) // 4 + 1
+
+
+def mmr_select(query_vectors, docs: List["Document"], doc_vectors, token_budget: int, mmr_lambda: float) -> List["Document"]:
+    """Pick chunks by maximal marginal relevance to the queries until the token budget is spent"""
+    def normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    
+    chunks = normalize(doc_vectors)
+    relevance = (chunks @ normalize(query_vectors).T).max(axis=1)  # Best match over all queries
+    similarity = chunks @ chunks.T
+    
+    selected = []
+    remaining = list(range(len(docs)))
+    budget = token_budget
+    while remaining and budget > 0:
+        redundancy = similarity[remaining][:, selected].max(axis=1) if selected else 0.0
+        scores = mmr_lambda * relevance[remaining] - (1 - mmr_lambda) * redundancy
+        best = remaining.pop(int(np.argmax(scores)))
+        tokens = estimate_tokens(docs[best].page_content)
+        # Skip chunks that don't fit, a shorter one further down may still do
+        if tokens > budget and selected:
+            continue
+        selected.append(best)
+        budget -= tokens
+    return [docs[i] for i in selected]
+
+
+def overlap_length(previous: str, text: str, max_overlap: int = CHUNK_OVERLAP, min_overlap: int = 20) -> int:
+    """Length of the longest end of previous that text starts with, as left by the splitter's chunk overlap"""
+    for length in range(min(len(previous), len(text), max_overlap), min_overlap - 1, -1):
+        if previous.endswith(text[:length]):
+            return length
+    return 0
+
+
+def trim_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to about max_tokens, at the last sentence or line end when there is one close by"""
+    cut = text[:max(0, (max_tokens - 1) * 4)]
+    end = max(cut.rfind(". "), cut.rfind("\n"))
+    return (cut[:end + 1] if end > len(cut) // 2 else cut).rstrip()
+
+
+def assemble_context(docs: List["Document"], token_budget: int):
+    """Build the prompt context from retrieved chunks, returning (context, tokens).
+
+    Chunks are grouped by source in order of their best rank and put back in page order,
+    with the overlap between neighbouring chunks removed. Sources are added until the
+    token budget is spent, the last one trimmed to fit.
+    """
+    groups = OrderedDict()
+    for doc in docs:
+        groups.setdefault(doc.metadata.get("source", ""), []).append(doc)
+    
+    sections = []
+    tokens = 0
+    for source, chunks in groups.items():
+        chunks = sorted(chunks, key=lambda doc: doc.metadata.get("start_index", 0))
+        text = chunks[0].page_content
+        for previous, chunk in zip(chunks, chunks[1:]):
+            overlap = overlap_length(previous.page_content, chunk.page_content)
+            text += chunk.page_content[overlap:] if overlap else "\n\n" + chunk.page_content
+        
+        title = " ".join((chunks[0].metadata.get("title") or "").split())
+        header = f"Source: {title} ({source})\n" if title else f"Source: {source}\n"
+        remaining = token_budget - tokens - estimate_tokens(header)
+        if estimate_tokens(text) > remaining:
+            text = trim_to_tokens(text, remaining)
+        if not text:
+            break
+        sections.append(header + text)
+        tokens += estimate_tokens(sections[-1])
+    return "\n\n".join(sections), tokens
+
+
+class QueryContext:
+    """State of one WebRAG query: its search questions, the sources found and the chunks retrieved"""
+    def __init__(self, question: str):
+        self.question = question
+        self.search_questions = []
+        self.sources = []  # Unique sources across all search questions, in citation order
+        self.chunks = 0  # Chunks indexed from the sources
+        self.docs = []  # Chunks retrieved as context for the answer
+        self.context_tokens = 0  # Estimated tokens of context sent to the model
+        self.search_success = False  # Whether any search loaded content
+        self.timings = RequestTimings()  # Time spent in each stage of this query
+
+    def add_results(self, sources: List[dict], chunks: int):
+        """Record the results of one search question"""
+        seen_urls = set(self.source_urls())
+        for source in sources:
+            if source["url"] not in seen_urls:
+                seen_urls.add(source["url"])
+                self.sources.append(source)
+        self.chunks += chunks
+        if chunks:
+            self.search_success = True
+
+    def source_urls(self) -> List[str]:
+        return [source["url"] for source in self.sources]
+
+
+class Speculation:
+    """Web search work started while the router is still deciding.
+
+    Generating the search questions and searching the question itself start alongside the
+    LLM decision. query_stream adopts the work when the web search wins, otherwise it is
+    cancelled and whatever already ran is counted as wasted.
+    """
+    def __init__(self, rag: "WebRAG", question: str, context: "QueryContext", events, notify):
+        self.rag = rag
+        self.question = question
+        self.context = context
+        self.events = events  # Where the speculative search reports progress and completion
+        self.notify = notify
+        self.started = None
+        self.deadline = None
+        self.questions_future = None
+        self.search_futures = {}  # future -> search question, as returned by _start_searches
+        self.tasks = {}  # future -> {"start": ..., "end": ...} run times of each task
+        self.finished = False
+
+    def _submit(self, executor, fn, *args, **kwargs) -> Future:
+        timing = {}
+        
+        def run():
+            timing["start"] = time.monotonic()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timing["end"] = time.monotonic()
+        
+        future = executor.submit(run)
+        self.tasks[future] = timing
+        return future
+
+    def start(self):
+        """Start generating search questions and searching the question itself"""
+        if self.started is not None:
+            return
+        logger.info("Starting web search speculatively")
+        self.started = time.monotonic()
+        self.deadline = self.started + QUERY_DEADLINE_SECONDS
+        self.questions_future = self._submit(
+            self.rag.speculation_executor, self.rag.generate_search_questions, self.question
+        )
+        future = self._submit(
+            self.rag.pipeline_executor, self.rag._search_and_load, self.question,
+            deadline=self.deadline, progress=self.notify, timings=self.context.timings
+        )
+        future.add_done_callback(self.notify)
+        self.search_futures[future] = self.question
+
+    def _adopted(self, search_questions: List[str], waited_from: float):
+        self.finished = True
+        metrics.inc("speculations_total", outcome="adopted")
+        # Generation would otherwise only have started once the decision was in
+        timing = self.tasks[self.questions_future]
+        metrics.observe("speculation_saved_seconds", min(timing["end"], waited_from) - timing["start"])
+        return search_questions, self.deadline, dict(self.search_futures)
+
+    def adopt(self):
+        """Take over the started work, returning (search_questions, deadline, futures)"""
+        waited_from = time.monotonic()
+        return self._adopted(self.questions_future.result(), waited_from)
+
+    async def aadopt(self):
+        """Async version of adopt"""
+        waited_from = time.monotonic()
+        return self._adopted(await asyncio.wrap_future(self.questions_future), waited_from)
+
+    def cancel(self):
+        """Abandon the work once the router decided against a web search"""
+        if self.started is None or self.finished:
+            return
+        self.finished = True
+        metrics.inc("speculations_total", outcome="cancelled")
+        for future, timing in self.tasks.items():
+            if future.cancel():
+                continue
+            # Running tasks can't be interrupted; count their time once they finish
+            metrics.inc("speculation_wasted_tasks_total")
+            future.add_done_callback(
+                lambda _, timing=timing: metrics.observe("speculation_wasted_seconds", timing["end"] - timing["start"])
+            )
+
+
+NO_RESULTS_MESSAGE = "I couldn't find reliable information about this topic from web searches. Please try a different question or be more specific."
+
+# Elements that never hold article text
+BOILERPLATE_TAGS = [
+    "script", "style", "noscript", "template", "svg", "canvas", "iframe",
+    "form", "button", "nav", "header", "footer", "aside"
+]
+
+# Exact class/id tokens of navigation, ads and other page chrome. Compounds such as
+# "has-sidebar" or "header-full-width" are left alone, since themes put them on <body> and content wrappers
+BOILERPLATE_CLASSES = {
+    "nav", "navbar", "navigation", "main-navigation", "site-navigation", "menu", "nav-menu",
+    "breadcrumb", "breadcrumbs", "sidebar", "widget-area", "footer", "site-footer", "header", "site-header",
+    "cookie", "cookies", "cookie-banner", "cookie-notice", "consent", "banner",
+    "ad", "ads", "advert", "advertisement", "promo", "sponsored",
+    "share", "share-buttons", "social", "social-share", "comments", "related", "related-posts",
+    "newsletter", "subscribe", "popup", "modal",
+}
+
+# Elements that hold the page content and are never removed as chrome
+CONTENT_TAGS = ["html", "body", "main", "article"]
+
+
+def holds_content(tag) -> bool:
+    """Whether a tag is or wraps the page content, so removing it would take the article with it"""
+    if tag.name in CONTENT_TAGS or tag.get("role") == "main":
+        return True
+    return tag.find(CONTENT_TAGS[2:]) is not None or tag.find(attrs={"role": "main"}) is not None
+
+
+def is_boilerplate(tag) -> bool:
+    """Whether a tag's class or id marks it as page chrome"""
+    tokens = [token.lower() for token in tag.get("class") or []]
+    tokens.append((tag.get("id") or "").lower())
+    return any(token in BOILERPLATE_CLASSES for token in tokens) and not holds_content(tag)
+
+
+def extract_main_text(soup) -> str:
+    """Extract the main article text of a page, leaving out navigation, ads and scripts"""
+    # e.g. ASP.NET pages wrap everything in one <form>, which must stay
+    for tag in soup(BOILERPLATE_TAGS):
+        if not tag.decomposed and not holds_content(tag):
+            tag.decompose()
+    for tag in soup.find_all(is_boilerplate):
+        if not tag.decomposed:
+            tag.decompose()
+    
+    # Prefer the largest article/main element when it holds a real amount of text
+    candidates = soup.find_all(["article", "main"]) + soup.find_all(attrs={"role": "main"})
+    root = max(candidates, key=lambda tag: len(tag.get_text(strip=True)), default=None)
+    if root is None or len(root.get_text(strip=True)) < 200:
+        root = soup.body or soup
+    
+    lines = (" ".join(line.split()) for line in root.get_text(separator="\n").splitlines())
+    return "\n".join(line for line in lines if line)
+
+
 # WebRAG class for web search functionality
 class WebRAG:
-    def __init__(self, google_api_key):
-        self.llm = ChatGoogleGenerativeAI(
+    def __init__(self, google_api_key=None, llm=None, embeddings: "Embeddings" = None, search=None):
+        # The llm, embeddings and search client can be injected, e.g. by the offline benchmark
+        if llm is None or embeddings is None:
+            from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+        self.llm = llm or ChatGoogleGenerativeAI(
             model="gemma-3-27b-it",
             google_api_key=google_api_key
         )
-        self.embeddings = GoogleGenerativeAIEmbeddings(
-            model="models/embedding-001",
-            google_api_key=google_api_key
+        self.embeddings = CachedEmbeddings(
+            embeddings or GoogleGenerativeAIEmbeddings(
+                model=EMBEDDING_MODEL,
+                google_api_key=google_api_key
+            ),
+            model=EMBEDDING_MODEL,
+            path=EMBEDDING_CACHE_PATH,
+            batch_size=EMBEDDING_BATCH_SIZE,
+            query_cache_size=QUERY_EMBEDDING_CACHE_SIZE,
+            max_bytes=EMBEDDING_CACHE_MAX_BYTES
+        )
+        self.search = search  # None means DuckDuckGo, created by the scheduler on first search
+        self.searcher = SearchScheduler(
+            self.search,
+            rate=SEARCH_RATE_PER_SECOND,
+            burst=SEARCH_BURST,
+            cache_ttl=SEARCH_CACHE_TTL,
+            cache_size=SEARCH_CACHE_SIZE
         )
-        self.search = DDGS()  # Using the updated DDGS class
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
         self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200
+            chunk_size=CHUNK_SIZE,
+            chunk_overlap=CHUNK_OVERLAP,
+            add_start_index=True  # Lets context assembly put chunks back in page order
+        )
+        self.page_cache = PageCache(PAGE_CACHE_PATH, PAGE_CACHE_TTL_SECONDS, PAGE_CACHE_MAX_BYTES)
+        self.search_questions_cache = SearchQuestionCache(SEARCH_QUESTIONS_CACHE_SIZE, SEARCH_QUESTIONS_CACHE_TTL)
+        self.http = create_http_session()  # Shared by all page loads so repeat hosts reuse connections
+        self._vectorstore = None  # Opened on first use, see the vectorstore property
+        self.vectorstore_open_lock = threading.Lock()
+        self.vectorstore_lock = threading.Lock()  # Guards the indexing counters
+        self.index_gate = SharedLock()  # Exclusive while retention deletes or compaction run
+        self.pending_chunks = {}  # chunk ID -> Event set once the worker embedding it stored it or gave up
+        self.chunks_embedded = 0
+        self.embeddings_saved = 0  # Duplicate chunks that were not embedded again
+        self.chunks_deleted = 0
+        self.deleted_since_compaction = 0
+        self.compactions = 0
+
+        # Separate worker pools so searches and page loads have their own concurrency limits.
+        # Each search question runs on the pipeline pool and only borrows a search or fetch worker per stage.
+        self.pipeline_executor = ThreadPoolExecutor(
+            max_workers=PIPELINE_CONCURRENCY, thread_name_prefix="webrag-pipeline"
+        )
+        self.search_executor = ThreadPoolExecutor(max_workers=SEARCH_CONCURRENCY, thread_name_prefix="webrag-search")
+        self.fetch_executor = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY, thread_name_prefix="webrag-fetch")
+        self.speculation_executor = ThreadPoolExecutor(
+            max_workers=SPECULATION_CONCURRENCY, thread_name_prefix="webrag-speculate"
         )
-        self.vectorstore = None
-        self.current_search_urls = []  # Track URLs used for the current search
+        # Retrieval has its own pool so it never waits behind other requests' page downloads
+        self.retrieval_executor = ThreadPoolExecutor(
+            max_workers=RETRIEVAL_CONCURRENCY, thread_name_prefix="webrag-retrieve"
+        )
+        
+        # Keep the persistent vectorstore within its retention policy
+        threading.Thread(target=self._maintenance_loop, name="webrag-maintenance", daemon=True).start()
+        
+        # Questions that go to the web are logged so the prefetcher can keep the hot ones warm
+        self.query_log = QueryLog(QUERY_LOG_PATH)
+        self.prefetcher = Prefetcher(self, self.query_log)
+        if PREFETCH_ENABLED:
+            self.prefetcher.start()
 
         # Create prompt template for web search results that includes source references
+        from langchain_core.prompts import PromptTemplate
         self.prompt = PromptTemplate.from_template("""
         Use the following context from web searches to answer the question.
         Compile all the informaiton from all the sources and provide a comprehensive answer.
@@ -70,15 +1995,35 @@ class WebRAG:
         
         Original question: "{question}"
         
-        Output the search queries as a numbered list without any additional explanation.
+        Output only a JSON array of strings, one search query each, without any additional explanation.
+        For example: ["first search query", "second search query", "third search query"]
         """)
 
+    def _parse_search_questions(self, question: str, result: str) -> List[str]:
+        """Parse the search questions returned by the LLM, collapse near-duplicates and cache them"""
+        questions = collapse_near_duplicates(parse_search_questions(result), SEARCH_QUESTIONS_DUPLICATE_SIMILARITY)
+        questions = questions[:SEARCH_QUESTIONS_MAX]
+        
+        # If parsing failed, use the original question as fallback
+        if not questions:
+            logger.warning("Failed to parse search questions, using original question")
+            return [question]
+        
+        self.search_questions_cache.put(question, questions)
+        logger.info(f"Generated {len(questions)} search questions")
+        return questions
+
     def generate_search_questions(self, question: str) -> List[str]:
         """Generate multiple search questions based on the original query"""
+        cached = self.search_questions_cache.get(question)
+        if cached:
+            logger.info(f"Search questions cache hit for: {question}")
+            return cached
         logger.info(f"Generating search questions for: {question}")
         
         try:
             # Create a chain to generate search questions
+            from langchain_core.output_parsers import StrOutputParser
             search_questions_chain = (
                 self.search_questions_prompt 
                 | self.llm 
@@ -87,80 +2032,51 @@ class WebRAG:
             
             # Generate the search questions
             result = search_questions_chain.invoke({"question": question})
-            
-            # Parse the numbered list into individual questions
-            questions = []
-            for line in result.strip().split('\n'):
-                # Remove numbering and any leading/trailing whitespace
-                if line and any(c.isdigit() for c in line):
-                    # Extract everything after the number and period/parenthesis
-                    cleaned_line = line.strip()
-                    idx = 0
-                    while idx < len(cleaned_line) and (cleaned_line[idx].isdigit() or cleaned_line[idx] in '.()\\ -'):
-                        idx += 1
-                    cleaned_line = cleaned_line[idx:].strip()
-                    if cleaned_line:
-                        questions.append(cleaned_line)
-            
-            # If parsing failed, use the original question as fallback
-            if not questions:
-                logger.warning("Failed to parse search questions, using original question")
-                questions = [question]
-            
-            logger.info(f"Generated {len(questions)} search questions")
-            return questions
+            return self._parse_search_questions(question, result)
         
         except Exception as e:
             logger.error(f"Error generating search questions: {str(e)}")
             return [question]  # Fall back to the original question
 
-    def search_and_load(self, query: str, num_results: int = 3) -> List[str]:
-        """Perform DuckDuckGo search and load webpage contents"""
-        logger.info(f"Searching the web for: {query}")
+    async def agenerate_search_questions(self, question: str) -> List[str]:
+        """Async version of generate_search_questions"""
+        cached = self.search_questions_cache.get(question)
+        if cached:
+            logger.info(f"Search questions cache hit for: {question}")
+            return cached
+        logger.info(f"Generating search questions for: {question}")
         
-        # Implement retry with exponential backoff
-        max_retries = 3
-        base_wait = 2  # seconds
+        try:
+            from langchain_core.output_parsers import StrOutputParser
+            search_questions_chain = (
+                self.search_questions_prompt 
+                | self.llm 
+                | StrOutputParser()
+            )
+            result = await search_questions_chain.ainvoke({"question": question})
+            return self._parse_search_questions(question, result)
         
-        for attempt in range(max_retries):
-            try:
-                # Using the new DDGS().text() method instead of results()
-                search_results = self.search.text(
-                    query, 
-                    region='wt-wt',  # Worldwide results
-                    safesearch='Off', 
-                    max_results=num_results
-                )
-                
-                # Convert to list since text() returns a generator
-                search_results = list(search_results)
-                
-                if search_results:
-                    break  # Success! Exit the retry loop
-                
-                logger.warning(f"Attempt {attempt+1}: No results returned from DuckDuckGo")
-                
-                if attempt < max_retries - 1:
-                    # Only wait if we're going to retry
-                    wait_time = base_wait * (2 ** attempt) + random.uniform(0, 1)  # Exponential backoff with jitter
-                    logger.info(f"Waiting {wait_time:.2f}s before retry...")
-                    time.sleep(wait_time)
-                    
-            except Exception as e:
-                logger.error(f"Attempt {attempt+1}: DuckDuckGo search error: {str(e)}")
-                if attempt < max_retries - 1:
-                    wait_time = base_wait * (2 ** attempt) + random.uniform(0, 1)
-                    logger.info(f"Waiting {wait_time:.2f}s before retry...")
-                    time.sleep(wait_time)
+        except Exception as e:
+            logger.error(f"Error generating search questions: {str(e)}")
+            return [question]  # Fall back to the original question
+
+    def search_web(self, query: str, num_results: int = 3, deadline: float = None,
+                   refresh_ahead: float = 0) -> List[dict]:
+        """Perform DuckDuckGo search and return the filtered sources"""
+        logger.info(f"Searching the web for: {query}")
         
-        # Process search results
-        urls = []
-        self.current_search_urls = []  # Reset current search URLs
+        try:
+            search_results = self.searcher.search(query, num_results, deadline=deadline, refresh_ahead=refresh_ahead)
+        except Exception as e:
+            logger.error(f"DuckDuckGo search error: {str(e)}")
+            search_results = []
         
         if not search_results:
             logger.warning(f"All attempts failed. No search results found for: {query}")
             return []
         
+        # Process search results
+        sources = []
         for result in search_results:
             # Extract fields from the search result
             # DDGS().text() returns dict with different structure
@@ -187,134 +2103,658 @@ class WebRAG:
             if not title or len(title) < 3:
                 title = f"Source from {domain}"
                 
-            # Add URL and title to the current search list
-            self.current_search_urls.append({
+            sources.append({
                 "url": url,
                 "title": title,
                 "domain": domain,
                 "snippet": snippet
             })
-            
-            urls.append(url)
             logger.info(f"Found result from domain: {domain}, title: {title}")
         
-        # If no valid URLs were found, return early
-        if not urls:
+        if not sources:
             logger.warning(f"No valid search results after filtering for: {query}")
+        return sources
+
+    def load_page(self, url: str, deadline: float = None, refresh_ahead: float = 0) -> List["Document"]:
+        """Load one webpage, serving it from the page cache when possible"""
+        from langchain_core.documents import Document
+        cached = self.page_cache.get(url, refresh_ahead)
+        if cached and cached["fresh"]:
+            logger.info(f"Page cache hit: {url}")
+            return [Document(page_content=cached["text"], metadata=dict(cached["metadata"], source=url))]
+        
+        # Ask the origin whether our stale copy is still valid
+        headers = {}
+        if cached:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+        
+        # Give up on this page at its own timeout or the request deadline, whichever comes first
+        page_deadline = time.monotonic() + PAGE_FETCH_TIMEOUT
+        if deadline is not None:
+            page_deadline = min(page_deadline, deadline)
+        timeout = max(0.1, page_deadline - time.monotonic())
+        
+        with self.http.get(url, headers=headers, timeout=timeout, stream=True) as response:
+            if cached and response.status_code == 304:
+                logger.info(f"Page cache revalidated: {url}")
+                self.page_cache.mark_revalidated(url)
+                return [Document(page_content=cached["text"], metadata=dict(cached["metadata"], source=url))]
+            response.raise_for_status()
+            
+            # Skip PDFs, images and other content we can't extract text from, before downloading it
+            content_type = response.headers.get("Content-Type", "")
+            mime_type = content_type.split(";")[0].strip().lower()
+            if mime_type and mime_type not in HTML_CONTENT_TYPES:
+                logger.info(f"Skipping non-HTML content ({mime_type}): {url}")
+                metrics.inc("pages_skipped_total", reason="content_type")
+                return []
+            
+            # Stream the body so huge or slow pages are cut off instead of buffered whole
+            body = bytearray()
+            cut_short = False  # Stopped by the deadline, so the text depends on timing
+            for chunk in response.iter_content(chunk_size=16384):
+                body.extend(chunk)
+                if len(body) >= PAGE_MAX_BYTES:
+                    logger.warning(f"Truncating {url} at {PAGE_MAX_BYTES} bytes")
+                    metrics.inc("pages_truncated_total", reason="size")
+                    break
+                if time.monotonic() > page_deadline:
+                    logger.warning(f"Truncating {url}, fetch deadline reached")
+                    metrics.inc("pages_truncated_total", reason="deadline")
+                    cut_short = True
+                    break
+            metrics.inc("fetched_bytes_total", len(body))
+            
+            charset = re.search(r"charset=([\w-]+)", content_type, re.IGNORECASE)
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+        
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(bytes(body), "html.parser", from_encoding=charset.group(1) if charset else None)
+        metadata = page_metadata(soup, url)
+        text = extract_main_text(soup)
+        if not text:
+            logger.warning(f"No main text extracted from: {url}")
             return []
         
-        # Load webpages
+        # A partial page must not be served as fresh later; size-capped pages are always cut the same way
+        if not cut_short:
+            self.page_cache.put(url, text, metadata, etag=etag, last_modified=last_modified)
+        return [Document(page_content=text, metadata=metadata)]
+
+    def iter_pages(self, urls: List[str], deadline: float = None, executor: ThreadPoolExecutor = None,
+                   refresh_ahead: float = 0, window: int = PAGES_IN_FLIGHT, timings: RequestTimings = None):
+        """Yield (url, documents) for each webpage as soon as it is loaded, until the deadline.
+
+        At most window pages are downloading or waiting for the caller at once. The next URL is only
+        submitted once the caller has taken a page, so a slow consumer holds back further downloads.
+        """
+        executor = executor or self.fetch_executor
+        queued = list(urls)
+        in_flight = {}
         try:
-            loader = WebBaseLoader(urls)
-            documents = loader.load()
-            logger.info(f"Loaded {len(documents)} documents from web search")
+            while queued or in_flight:
+                while queued and len(in_flight) < max(1, window):
+                    url = queued.pop(0)
+                    in_flight[executor.submit(self.load_page, url, deadline, refresh_ahead)] = url
+                
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                with metrics.span("load_pages", timings):
+                    done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                
+                for future in done:
+                    url = in_flight.pop(future)
+                    try:
+                        documents = future.result()
+                    except Exception as e:
+                        logger.error(f"Error loading {url}: {str(e)}")
+                        continue
+                    yield url, documents
+        finally:
+            for future, url in in_flight.items():
+                future.cancel()
+                logger.warning(f"Deadline reached before loading: {url}")
+            for url in queued:
+                logger.warning(f"Deadline reached before loading: {url}")
+
+    @property
+    def vectorstore(self):
+        """The vector backend (Chroma or the quantized index), opened on first use"""
+        if self._vectorstore is None:
+            with self.vectorstore_open_lock:
+                if self._vectorstore is None:
+                    self._vectorstore = self._open_vectorstore()
+        return self._vectorstore
+
+    @vectorstore.setter
+    def vectorstore(self, vectorstore):
+        self._vectorstore = vectorstore
+
+    def _open_vectorstore(self):
+        if VECTORSTORE_BACKEND == "quantized":
+            return QuantizedVectorStore(QUANTIZED_INDEX_PATH, QUANTIZED_RESCORE, QUANTIZED_RESCORE_FACTOR)
+        return ChromaVectorStore(self.embeddings, VECTORSTORE_PATH, VECTORSTORE_COLLECTION)
+
+    def index_documents(self, splits: List["Document"], timings: RequestTimings = None,
+                        deadline: float = None) -> int:
+        """Embed splits into the vectorstore, skipping chunks that are already stored.
+
+        Chunks another worker is embedding right now are waited for until the deadline, and embedded
+        here if that worker failed. Returns the number of distinct chunks that are in the store.
+        """
+        now = time.time()
+        
+        # Stable IDs from source and content so the same chunk always maps to the same record
+        chunks = {}
+        for doc in splits:
+            doc.metadata["indexed_at"] = now  # Used by the retention policy
+            chunks.setdefault(document_id(doc), doc)
+        with self.vectorstore_lock:
+            self.embeddings_saved += len(splits) - len(chunks)
+        
+        stored = 0
+        remaining = list(chunks)
+        while remaining:
+            # Claim the IDs nobody else is embedding right now, and note the events of the others
+            claimed, waiting = [], {}
+            with self.vectorstore_lock:
+                for id_ in remaining:
+                    if id_ in self.pending_chunks:
+                        waiting[id_] = self.pending_chunks[id_]
+                    else:
+                        self.pending_chunks[id_] = threading.Event()
+                        claimed.append(id_)
             
-            # Skip if no documents were loaded
-            if not documents:
-                logger.warning(f"No content loaded from URLs: {urls}")
-                return []
+            if claimed:
+                try:
+                    stored += self._index_claimed(claimed, chunks, timings)
+                finally:
+                    with self.vectorstore_lock:
+                        for id_ in claimed:
+                            self.pending_chunks.pop(id_).set()
+            
+            if not waiting:
+                break
+            for event in waiting.values():
+                if not event.wait(None if deadline is None else max(0.0, deadline - time.monotonic())):
+                    break
+            
+            # Count only what the other worker actually stored; retry the rest unless time is up
+            try:
+                with self.index_gate.shared():
+                    present = set(self.vectorstore.existing_ids(list(waiting)))
+            except Exception as e:
+                logger.error(f"Error checking existing chunks: {str(e)}")
+                break
+            stored += len(present)
+            with self.vectorstore_lock:
+                self.embeddings_saved += len(present)
+            remaining = [id_ for id_ in waiting if id_ not in present]
+            if deadline is not None and time.monotonic() >= deadline:
+                if remaining:
+                    logger.warning(f"Deadline reached before {len(remaining)} chunks were indexed")
+                break
+        return stored
+
+    def _index_claimed(self, ids: List[str], chunks: dict, timings: RequestTimings = None) -> int:
+        """Embed and insert chunks this worker claimed, returning how many are stored afterwards"""
+        with self.index_gate.shared():
+            existing = []
+            try:
+                existing = self.vectorstore.existing_ids(ids)
+                if existing:
+                    # Refresh the retention clock of chunks we saw again, no embedding needed
+                    self.vectorstore.update_metadata(existing, [chunks[id_].metadata for id_ in existing])
+                existing = set(existing)
+                ids = [id_ for id_ in ids if id_ not in existing]
+            except Exception as e:
+                logger.error(f"Error checking existing chunks: {str(e)}")
+            
+            with self.vectorstore_lock:
+                self.chunks_embedded += len(ids)
+                self.embeddings_saved += len(existing)
+            logger.info(f"Embedding {len(ids)} new chunks, skipped {len(existing)} duplicates")
+            
+            if not ids:
+                return len(existing)
             
-            # Split documents
-            splits = self.text_splitter.split_documents(documents)
+            documents = [chunks[id_] for id_ in ids]
+            try:
+                with metrics.span("embed", timings):
+                    vectors = self.embeddings.embed_documents([doc.page_content for doc in documents])
+            except Exception as e:
+                logger.error(f"Error embedding documents: {str(e)}")
+                return len(existing)
             
-            # Create or update vectorstore
-            if self.vectorstore is None:
+            try:
+                with metrics.span("insert", timings):
+                    self._insert(ids, vectors, documents)
+                return len(existing) + len(ids)
+            except Exception as e:
+                logger.error(f"Error adding documents to vectorstore: {str(e)}")
+                # Try to re-initialize the vectorstore as a fallback
                 try:
-                    self.vectorstore = Chroma.from_documents(
-                        documents=splits,
-                        embedding=self.embeddings,
-                        persist_directory="./web_chroma_db"
-                    )
-                except Exception as e:
-                    logger.error(f"Error creating vectorstore: {str(e)}")
-                    return []
-            else:
+                    self.vectorstore = self._open_vectorstore()
+                    self._insert(ids, vectors, documents)
+                    return len(existing) + len(ids)
+                except Exception as e2:
+                    logger.error(f"Error re-initializing vectorstore: {str(e2)}")
+                    return len(existing)
+
+    def _insert(self, ids: List[str], vectors: List[List[float]], documents: List["Document"]):
+        self.vectorstore.upsert(
+            ids, vectors, [doc.page_content for doc in documents], [doc.metadata for doc in documents]
+        )
+
+    def maintain_vectorstore(self):
+        """Apply the retention policy and compact the collection once enough chunks were removed"""
+        with self.index_gate.shared():
+            ids, metadatas = self.vectorstore.all_metadata()
+        
+        # Oldest first; chunks indexed before retention tracking count as oldest
+        entries = sorted(
+            zip(ids, metadatas),
+            key=lambda entry: (entry[1] or {}).get("indexed_at", 0)
+        )
+        cutoff = time.time() - VECTORSTORE_RETENTION_DAYS * 24 * 3600
+        expired = sum(1 for _, metadata in entries if (metadata or {}).get("indexed_at", 0) < cutoff)
+        excess = max(0, len(entries) - expired - VECTORSTORE_MAX_CHUNKS)
+        doomed = [id_ for id_, _ in entries[:expired + excess]]
+        
+        if doomed:
+            with self.index_gate.exclusive():
+                for start in range(0, len(doomed), VECTORSTORE_BATCH_SIZE):
+                    self.vectorstore.delete(doomed[start:start + VECTORSTORE_BATCH_SIZE])
+            with self.vectorstore_lock:
+                self.chunks_deleted += len(doomed)
+                self.deleted_since_compaction += len(doomed)
+            logger.info(f"Removed {expired} expired and {excess} excess chunks from the vectorstore")
+        
+        # Deleted chunks stay in the HNSW index or the vector files until the next compaction
+        live = len(entries) - len(doomed)
+        if self.deleted_since_compaction > VECTORSTORE_COMPACT_RATIO * max(live, 1):
+            self.compact_vectorstore()
+
+    def compact_vectorstore(self):
+        """Rebuild the index so it only holds live chunks"""
+        logger.info("Compacting vectorstore...")
+        # Requests keep indexing and retrieving during the rebuild; only the switch over is exclusive
+        self.vectorstore.compact(self.index_gate.exclusive)
+        with self.vectorstore_lock:
+            self.deleted_since_compaction = 0
+            self.compactions += 1
+        logger.info("Vectorstore compaction finished")
+
+    def _maintenance_lock_path(self) -> str:
+        if VECTORSTORE_BACKEND == "quantized":
+            return os.path.join(QUANTIZED_INDEX_PATH, "maintenance.lock")
+        return VECTORSTORE_PATH.rstrip("/\\") + ".maintenance.lock"
+
+    def _maintenance_loop(self):
+        # With several server workers only the one holding the lock deletes and compacts;
+        # the others wait here and take over if it exits
+        with process_lock(self._maintenance_lock_path()):
+            while True:
+                # Wait first, so starting the server doesn't open the vectorstore
+                time.sleep(VECTORSTORE_MAINTENANCE_INTERVAL)
                 try:
-                    self.vectorstore.add_documents(splits)
+                    self.maintain_vectorstore()
                 except Exception as e:
-                    logger.error(f"Error adding documents to vectorstore: {str(e)}")
-                    # Try to re-initialize the vectorstore as a fallback
-                    try:
-                        self.vectorstore = Chroma.from_documents(
-                            documents=splits,
-                            embedding=self.embeddings,
-                            persist_directory="./web_chroma_db"
-                        )
-                    except Exception as e2:
-                        logger.error(f"Error re-initializing vectorstore: {str(e2)}")
-                        return []
+                    logger.error(f"Error maintaining vectorstore: {str(e)}")
+
+    def index_stats(self) -> dict:
+        """Return counters for chunks embedded, deduplicated and removed by retention"""
+        with self.vectorstore_lock:
+            return {
+                "backend": VECTORSTORE_BACKEND,
+                "chunks_embedded": self.chunks_embedded,
+                "embeddings_saved": self.embeddings_saved,
+                "chunks_deleted": self.chunks_deleted,
+                "compactions": self.compactions
+            }
+
+    def _search_and_load(self, query: str, num_results: int = 3, deadline: float = None, progress=None,
+                         timings: RequestTimings = None, executor: ThreadPoolExecutor = None,
+                         refresh_ahead: float = 0):
+        """Search, load and index one query, returning (sources, chunks indexed).
+
+        Each page is split and indexed in micro-batches as soon as it arrives, while the other pages
+        are still downloading, so only the pages in flight are held in memory.
+        executor and refresh_ahead let the prefetcher use its own fetch pool and renew cache entries early.
+        """
+        progress = progress or (lambda event: None)
+        
+        def search():
+            with metrics.span("search", timings):
+                return self.search_web(query, num_results=num_results, deadline=deadline, refresh_ahead=refresh_ahead)
+        
+        # Only the search itself holds a search worker, so the next query can search while this one loads
+        future = self.search_executor.submit(search)
+        try:
+            sources = future.result(timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+        except FuturesTimeoutError:
+            future.cancel()
+            logger.warning(f"Deadline reached before searching: {query}")
+            sources = []
+        progress({"status": "progress", "stage": "search_done", "query": query, "results": len(sources)})
+        if not sources:
+            return [], 0
+        
+        urls = [source["url"] for source in sources]
+        
+        # Split and index each webpage while the rest are still loading
+        pages = chunks = 0
+        try:
+            for url, documents in self.iter_pages(urls, deadline=deadline, executor=executor,
+                                                  refresh_ahead=refresh_ahead, timings=timings):
+                if not documents:
+                    continue
+                pages += 1
                 
-            return splits
+                with metrics.span("split", timings):
+                    splits = self.text_splitter.split_documents(documents)
+                
+                indexed = 0
+                for start in range(0, len(splits), INDEX_BATCH_SIZE):
+                    batch = splits[start:start + INDEX_BATCH_SIZE]
+                    indexed += self.index_documents(batch, timings, deadline=deadline)
+                chunks += indexed
+                progress({"status": "progress", "stage": "page_indexed", "query": query, "url": url, "chunks": indexed})
         except Exception as e:
             logger.error(f"Error loading web content: {str(e)}")
+        
+        logger.info(f"Indexed {chunks} chunks from {pages} of {len(urls)} pages")
+        progress({"status": "progress", "stage": "pages_loaded", "query": query, "pages": pages})
+        if not pages:
+            logger.warning(f"No content loaded from URLs: {urls}")
+        return sources, chunks
+
+    def _start_searches(self, search_questions: List[str], deadline: float, notify, context: "QueryContext"):
+        """Submit one search-and-load task per search question.
+
+        notify receives the workers' progress events and each future once it finishes.
+        """
+        futures = {}
+        for search_question in search_questions:
+            future = self.pipeline_executor.submit(
+                self._search_and_load, search_question,
+                deadline=deadline, progress=notify, timings=context.timings
+            )
+            future.add_done_callback(notify)
+            futures[future] = search_question
+        return futures
+
+    def _collect_sources(self, futures: dict, pending: set, context: "QueryContext"):
+        """Cancel searches that missed the deadline and record the results of the rest in context"""
+        for future in pending:
+            future.cancel()
+            logger.warning(f"Deadline reached before finishing search: {futures[future]}")
+        
+        # Merge in submission order so citations are stable
+        for future in futures:
+            if future in pending:
+                continue
+            try:
+                sources, chunks = future.result()
+            except Exception as e:
+                logger.error(f"Error searching for '{futures[future]}': {str(e)}")
+                continue
+            context.add_results(sources, chunks)
+
+    def _embed_queries(self, queries: List[str], deadline: float):
+        """Embed retrieval queries in parallel, dropping the queries not embedded by the deadline"""
+        futures = [self.retrieval_executor.submit(self.embeddings.embed_query, query) for query in queries]
+        wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+        
+        kept, vectors = [], []
+        for query, future in zip(queries, futures):
+            if future.done() and not future.exception():
+                kept.append(query)
+                vectors.append(future.result())
+            else:
+                future.cancel()
+                logger.warning(f"Retrieval budget reached before embedding: {query}")
+        return kept, vectors
+
+    def _query_index(self, query_vectors, n_results: int, sources: List[str]):
+        with self.index_gate.shared():
+            return self.vectorstore.query(query_vectors, n_results, sources)
+
+    def retrieve(self, context: "QueryContext") -> List["Document"]:
+        """Retrieve chunks for the question and its search questions, reranked by MMR within the token budget"""
+        deadline = time.monotonic() + RETRIEVAL_TIMEOUT
+        queries = list(dict.fromkeys([context.question] + context.search_questions))
+        queries, query_vectors = self._embed_queries(queries, deadline)
+        if not queries:
+            metrics.inc("retrieval_timeouts_total", stage="embed")
+            return []
+        
+        # One index lookup for all queries, only over the pages loaded for this question
+        future = self.retrieval_executor.submit(
+            self._query_index,
+            query_vectors,
+            min(RETRIEVAL_CANDIDATES, max(1, context.chunks)),
+            context.source_urls()
+        )
+        try:
+            results = future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FuturesTimeoutError:
+            # The lookup finishes in the background; the answer goes ahead without context
+            logger.warning("Retrieval budget reached before the index lookup finished")
+            metrics.inc("retrieval_timeouts_total", stage="index")
+            return []
+        
+        # Merge the hits of all queries, keeping each chunk once
+        candidates = {}
+        for hits in results:
+            for id, doc, vector in hits:
+                candidates.setdefault(id, (doc, vector))
+        if not candidates:
             return []
+        
+        docs, doc_vectors = zip(*candidates.values())
+        selected = mmr_select(query_vectors, list(docs), doc_vectors, CONTEXT_TOKEN_BUDGET, RETRIEVAL_MMR_LAMBDA)
+        logger.info(f"Retrieved {len(selected)} of {len(candidates)} candidate chunks for {len(queries)} queries")
+        return selected
+
+    def _retrieve_context(self, context: "QueryContext") -> str:
+        """Retrieve context for the question from the pages loaded for it, recording the chunks in context"""
+        try:
+            with metrics.span("retrieval", context.timings):
+                context.docs = self.retrieve(context)
+                text, context.context_tokens = assemble_context(context.docs, CONTEXT_TOKEN_BUDGET)
+            metrics.inc("context_tokens_total", context.context_tokens)
+            return text
+        except Exception as e:
+            logger.error(f"Error retrieving context: {str(e)}")
+            return "Error retrieving context information."
+
+    def _rag_chain(self):
+        from langchain_core.output_parsers import StrOutputParser
+        return (
+            self.prompt
+            | self.llm
+            | StrOutputParser()
+        )
+
+    def _answer_footer(self, answer: str, sources: List[dict]) -> List[dict]:
+        """Events that close a streamed answer: the sources section and the answer_done marker"""
+        # Only append sources if we have valid sources and didn't get a "couldn't find information" response
+        if sources and "couldn't find relevant information" not in answer.lower():
+            sources_section = "\n\n**Sources:**\n"
+            for i, source in enumerate(sources):
+                title = source.get("title") or f"Source {i+1}"
+                url = source.get("url")
+                sources_section += f"- [{title}]({url})\n"
+            
+            return [
+                {"token": sources_section},
+                {"status": "progress", "stage": "answer_done", "found": True}
+            ]
+        return [{"status": "progress", "stage": "answer_done", "found": False}]
+
+    def speculation(self, question: str, context: "QueryContext") -> Speculation:
+        """Speculative web search work for query_stream, started by the router when it asks the LLM"""
+        events = queue.Queue()
+        return Speculation(self, question, context, events, events.put)
+
+    def aspeculation(self, question: str, context: "QueryContext") -> Speculation:
+        """Speculative web search work for aquery_stream; call from the event loop"""
+        events, notify = self._async_channel()
+        return Speculation(self, question, context, events, notify)
+
+    def _async_channel(self):
+        """Queue on the running event loop, plus a function worker threads use to put items on it"""
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        
+        def notify(item):
+            # Called from worker threads; the request may already be gone
+            try:
+                loop.call_soon_threadsafe(events.put_nowait, item)
+            except RuntimeError:
+                pass
+        
+        return events, notify
 
-    def query(self, question: str) -> str:
-        """Process query through RAG pipeline"""
+    def query_stream(self, question: str, context: "QueryContext" = None, speculation: Speculation = None):
+        """Process query through RAG pipeline, yielding progress events and answer tokens as they arrive.
+
+        All state of the request is kept in context, so concurrent queries never share results.
+        Work already started by a speculation is taken over instead of being repeated.
+        """
+        context = context or QueryContext(question)
+        
         # First search and load relevant content
         try:            
+            # Only the prefetcher reads (and prunes) the log, so nothing is kept without it
+            if PREFETCH_ENABLED:
+                self.query_log.record(question)
+            
             # Generate multiple search questions
-            search_questions = self.generate_search_questions(question)
+            with metrics.span("generate_search_questions", context.timings):
+                if speculation is not None and speculation.started is not None:
+                    search_questions, deadline, futures = speculation.adopt()
+                    events, notify = speculation.events, speculation.notify
+                else:
+                    search_questions = self.generate_search_questions(question)
+                    deadline = time.monotonic() + QUERY_DEADLINE_SECONDS
+                    events = queue.Queue()  # Progress events from the workers, plus finished futures
+                    notify = events.put
+                    futures = {}
+            context.search_questions = search_questions
+            yield {"status": "progress", "stage": "questions_generated", "questions": search_questions}
             
-            # Search for each question
-            all_urls_set = set()  # Track unique URLs to avoid duplicates
-            search_success = False  # Track if any search was successful
+            # Fan the search questions out in parallel under a shared deadline
+            new_questions = [q for q in search_questions if q not in futures.values()]
+            futures.update(self._start_searches(new_questions, deadline, notify, context))
             
-            for search_question in search_questions:
-                logger.info(f"Searching for question: {search_question}")
-                results = self.search_and_load(search_question)
-                if results:  # If we got any valid results
-                    search_success = True
-                
-                # Keep track of unique URLs for citation
-                current_urls = {source["url"] for source in self.current_search_urls}
-                all_urls_set.update(current_urls)
+            # Relay worker progress until every search finished or the deadline passed
+            pending = set(futures)
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    event = events.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if isinstance(event, Future):
+                    pending.discard(event)
+                else:
+                    yield event
             
-            # If no successful searches or vectorstore is still None, return early with a friendly message
-            if not search_success or self.vectorstore is None:
-                logger.warning("No valid search results found or vectorstore not initialized")
-                return "I couldn't find reliable information about this topic from web searches. Please try a different question or be more specific."
+            self._collect_sources(futures, pending, context)
             
-            # Create retriever function with proper error handling
-            def retrieve_context(question):
-                try:
-                    docs = self.vectorstore.similarity_search(question, k=5)
-                    return "\n".join([doc.page_content for doc in docs])
-                except Exception as e:
-                    logger.error(f"Error retrieving context: {str(e)}")
-                    return "Error retrieving context information."
-
-            # Create RAG chain
-            rag_chain = (
-                {
-                    "context": retrieve_context,
-                    "question": RunnablePassthrough()
-                }
-                | self.prompt
-                | self.llm
-                | StrOutputParser()
-            )
+            # If no successful searches, return early with a friendly message
+            if not context.search_success:
+                logger.warning("No valid search results found")
+                yield {"token": NO_RESULTS_MESSAGE}
+                return
+            
+            retrieved = self._retrieve_context(context)
+            yield {"status": "progress", "stage": "retrieval_done", "chunks": len(context.docs), "tokens": context.context_tokens}
 
-            # Get the answer from the RAG chain
-            answer = rag_chain.invoke(question)
+            # Stream the answer from the RAG chain
+            answer = ""
+            with metrics.span("generation", context.timings):
+                for token in self._rag_chain().stream({"context": retrieved, "question": question}):
+                    answer += token
+                    # Clean up any unexpected EOF markers that might be in the response
+                    token = token.replace("EOF", "")
+                    if token:
+                        yield {"token": token}
             
-            # Only append sources if we have valid sources and didn't get a "couldn't find information" response
-            if self.current_search_urls and "couldn't find relevant information" not in answer.lower():
-                sources_section = "\n\n**Sources:**\n"
-                for i, source in enumerate(self.current_search_urls):
-                    title = source.get("title") or f"Source {i+1}"
-                    url = source.get("url")
-                    sources_section += f"- [{title}]({url})\n"
-                
-                answer += sources_section
+            for event in self._answer_footer(answer, context.sources):
+                yield event
+        except Exception as e:
+            logger.error(f"Error in web RAG query: {str(e)}")
+            yield {"token": f"I encountered an error while searching the web: {str(e)}"}
+
+    async def aquery_stream(self, question: str, context: "QueryContext" = None, speculation: Speculation = None):
+        """Async version of query_stream that waits on the worker pools without blocking a thread"""
+        context = context or QueryContext(question)
+        
+        try:
+            if PREFETCH_ENABLED:
+                await asyncio.to_thread(self.query_log.record, question)
+            with metrics.span("generate_search_questions", context.timings):
+                if speculation is not None and speculation.started is not None:
+                    search_questions, deadline, futures = await speculation.aadopt()
+                    events, notify = speculation.events, speculation.notify
+                else:
+                    search_questions = await self.agenerate_search_questions(question)
+                    deadline = time.monotonic() + QUERY_DEADLINE_SECONDS
+                    events, notify = self._async_channel()
+                    futures = {}
+            context.search_questions = search_questions
+            yield {"status": "progress", "stage": "questions_generated", "questions": search_questions}
+            
+            new_questions = [q for q in search_questions if q not in futures.values()]
+            futures.update(self._start_searches(new_questions, deadline, notify, context))
+            
+            pending = set(futures)
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(events.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                if isinstance(event, Future):
+                    pending.discard(event)
+                else:
+                    yield event
+            
+            self._collect_sources(futures, pending, context)
+            
+            if not context.search_success:
+                logger.warning("No valid search results found")
+                yield {"token": NO_RESULTS_MESSAGE}
+                return
             
-            # Clean up any unexpected EOF markers that might be in the response
-            answer = answer.replace("EOF", "").strip()
+            retrieved = await asyncio.to_thread(self._retrieve_context, context)
+            yield {"status": "progress", "stage": "retrieval_done", "chunks": len(context.docs), "tokens": context.context_tokens}
             
-            return answer
+            answer = ""
+            with metrics.span("generation", context.timings):
+                async for token in self._rag_chain().astream({"context": retrieved, "question": question}):
+                    answer += token
+                    token = token.replace("EOF", "")
+                    if token:
+                        yield {"token": token}
+            
+            for event in self._answer_footer(answer, context.sources):
+                yield event
         except Exception as e:
             logger.error(f"Error in web RAG query: {str(e)}")
-            return f"I encountered an error while searching the web: {str(e)}"
+            yield {"token": f"I encountered an error while searching the web: {str(e)}"}
 
 app = Flask(__name__)
 
@@ -343,81 +2783,392 @@ if not api_key:
     print("Please create a .env file with your GOOGLE_API_KEY=your_api_key_here")
     print("You can get an API key from https://makersuite.google.com/app/apikey")
 
-# Initialize components when API key is available
-if api_key:
-    try:
-        # Initialize the main Gemini model
-        llm = ChatGoogleGenerativeAI(
-            model="gemma-3-27b-it", 
-            google_api_key=api_key,
-            disable_streaming=False
-        )
-        
-        # Initialize the WebRAG system
-        web_rag = WebRAG(google_api_key=api_key)
-        
-        # Define prompt template for web search decision
-        web_search_decision_template = """
-        You are Research Navigator, an AI assistant that determines if a question requires searching the web.
-        
-        For the following question, answer with only "Yes" if you need to search the web for current information, 
-        or "No" if you already have enough knowledge to answer accurately without searching.
+# Define prompt template for web search decision
+web_search_decision_template = """
+You are Research Navigator, an AI assistant that determines if a question requires searching the web.
+
+For the following question, answer with only "Yes" if you need to search the web for current information, 
+or "No" if you already have enough knowledge to answer accurately without searching.
+
+Question: "{question}"
+"""
+
+# Define prompt template for regular questions
+standard_prompt_template = """
+You are Research Navigator, an AI research assistant designed to provide helpful, 
+accurate, and thoughtful responses to research questions.
+
+User question: "{question}"
+
+Provide a well-structured and comprehensive answer.
+"""
+
+def llm_web_search_decision(question: str) -> bool:
+    """Ask the LLM whether the question needs a web search"""
+    return "yes" in web_search_decision_chain.invoke({"question": question}).strip().lower()
+
+async def allm_web_search_decision(question: str) -> bool:
+    """Async version of llm_web_search_decision"""
+    result = await web_search_decision_chain.ainvoke({"question": question})
+    return "yes" in result.strip().lower()
+
+def init_components(chat_model, rag):
+    """Build the chains, router and answer cache around a chat model and a WebRAG instance.
+
+    Called by ensure_components with the Gemini models; the benchmark calls it with fakes.
+    """
+    global llm, web_rag, answer_cache, web_search_decision_chain, web_search_router, standard_chain
+    # Imported here rather than at the top, since langchain_core.prompts dominates the import of app.py
+    from langchain_core.prompts import PromptTemplate
+    from langchain_core.output_parsers import StrOutputParser
+    web_rag = rag
+    
+    # Cache final answers so repeated questions skip the whole pipeline
+    answer_cache = AnswerCache(
+        max_entries=ANSWER_CACHE_SIZE,
+        web_ttl=ANSWER_CACHE_WEB_TTL,
+        standard_ttl=ANSWER_CACHE_STANDARD_TTL,
+        embeddings=web_rag.embeddings if ANSWER_CACHE_SEMANTIC else None,
+        similarity_threshold=ANSWER_CACHE_SIMILARITY
+    )
+    
+    # Create the web search decision chain
+    web_search_decision_chain = (
+        PromptTemplate.from_template(web_search_decision_template)
+        | chat_model
+        | StrOutputParser()
+    )
+    
+    # Decide locally when the question is clear-cut, otherwise ask the LLM
+    web_search_router = WebSearchRouter(
+        classifier=heuristic_web_search_classifier,
+        fallback=llm_web_search_decision,
+        afallback=allm_web_search_decision,
+        confidence_threshold=ROUTER_CONFIDENCE_THRESHOLD,
+        memo_size=ROUTER_MEMO_SIZE
+    )
+    
+    # Create the standard chain
+    standard_chain = (
+        PromptTemplate.from_template(standard_prompt_template)
+        | chat_model
+        | StrOutputParser()
+    )
+    
+    # Set last, since a non-None llm is what marks the components as ready
+    llm = chat_model
+    init_state["status"] = "ready"
+
+llm = None
+web_rag = None
+answer_cache = None
+web_search_decision_chain = None
+web_search_router = None
+standard_chain = None
+
+# Readiness of the models and WebRAG, reported by /api/status
+init_lock = threading.Lock()
+init_state = {"status": "pending", "seconds": None, "error": None}
+
+def components_ready() -> bool:
+    return llm is not None and web_rag is not None
+
+def ensure_components() -> bool:
+    """Build the Gemini models and WebRAG on first use, returning whether they are ready.
+
+    The first caller pays for the imports and clients; concurrent callers wait for it.
+    """
+    if components_ready():
+        return True
+    if not api_key:
+        return False
+    
+    with init_lock:
+        if components_ready():
+            return True
+        if init_state["status"] == "failed":
+            return False
         
-        Question: "{question}"
-        """
+        init_state["status"] = "initializing"
+        start = time.perf_counter()
+        if DNS_CACHE_TTL > 0:
+            dns_cache.install()
+        try:
+            from langchain_google_genai import ChatGoogleGenerativeAI
+            init_components(
+                # Initialize the main Gemini model
+                ChatGoogleGenerativeAI(
+                    model="gemma-3-27b-it", 
+                    google_api_key=api_key,
+                    disable_streaming=False
+                ),
+                # Initialize the WebRAG system
+                WebRAG(google_api_key=api_key)
+            )
+            init_state["seconds"] = round(time.perf_counter() - start, 3)
+            print(f"Gemini models and WebRAG initialized successfully in {init_state['seconds']}s!")
+            return True
+        except Exception as e:
+            print(f"ERROR initializing Gemini model or WebRAG: {e}")
+            init_state.update(status="failed", error=str(e))
+            return False
+
+# Start building the models in the background so the server answers health checks right away
+if not api_key:
+    print("No API key found, models NOT initialized.")
+elif EAGER_INIT:
+    threading.Thread(target=ensure_components, name="init-components", daemon=True).start()
+
+def sse(payload: dict) -> str:
+    """Format one Server-Sent Event"""
+    return 'data: ' + json.dumps(payload) + '\n\n'
 
-        web_search_decision_prompt = PromptTemplate.from_template(web_search_decision_template)
+
+class ChatTurn:
+    """Caching, metrics and event bookkeeping of one /api/chat answer, shared by the Flask and ASGI routes"""
+    THINKING = {'token': "Thinking if I need to search the web...\n"}
+    SEARCHING = {'token': "I need to search the web for this. One moment...\n\n"}
+    NOT_SEARCHING = {'token': "I can answer this without searching the web.\n\n"}
+
+    def __init__(self, question: str, include_timings: bool = False):
+        self.question = question
+        self.include_timings = include_timings
+        self.context = QueryContext(question)
+        self.start = time.perf_counter()
+        self.path = "standard"
+        self.first_token = True
+        self.answer = ""
+        self.found = False  # Whether the web answer cited any sources
+
+    def lookup(self):
+        """Return the events answering from the answer cache, or None on a miss"""
+        with metrics.span("answer_cache_lookup", self.context.timings):
+            cached, similarity = answer_cache.get(self.question)
+        if not cached:
+            return None
+        self.path = "cache"
+        logger.info(f"Answer cache hit (similarity {similarity:.3f})")
+        hit = {'status': 'cache_hit', 'cache_hit': True, 'similarity': similarity, 'web_search': cached['web_search']}
+        self._token_seen()
+        return [hit, {'token': cached['answer']}, self.complete(True)]
+
+    def speculation(self, asynchronous: bool = False):
+        """Start of the web search to run while the router decides, if SPECULATIVE_START is on"""
+        if not SPECULATIVE_START:
+            return None
+        if asynchronous:
+            return web_rag.aspeculation(self.question, self.context)
+        return web_rag.speculation(self.question, self.context)
+
+    def decided(self, need_web_search: bool, speculation: Speculation = None) -> dict:
+        """Record the router's decision, returning the event announcing it"""
+        logger.info(f"Web search decision: {need_web_search}")
+        if need_web_search:
+            self.path = "web"
+            return self.SEARCHING
+        if speculation:
+            speculation.cancel()
+        return self.NOT_SEARCHING
+
+    def _token_seen(self):
+        if self.first_token:
+            self.first_token = False
+            metrics.observe("time_to_first_token_seconds", time.perf_counter() - self.start, path=self.path)
+
+    def web_event(self, event: dict) -> dict:
+        """Account for one event of the web RAG stream"""
+        if 'token' in event:
+            self._token_seen()
+        self.answer += event.get('token', '')
+        self.found = self.found or (event.get('stage') == 'answer_done' and event['found'])
+        return event
+
+    def token(self, token: str) -> dict:
+        """Account for one token of the standard chain"""
+        self._token_seen()
+        self.answer += token
+        return {'token': token}
+
+    def store(self):
+        """Cache the finished answer; web answers only when they were backed by sources"""
+        if self.path == "web" and not self.found:
+            return
+        answer_cache.put(self.question, self.answer.strip(), web_search=self.path == "web")
+
+    def complete(self, cache_hit: bool = False) -> dict:
+        event = {'status': 'complete', 'cache_hit': cache_hit}
+        if self.include_timings:
+            event['timings'] = dict(self.context.timings.as_dict(), total=round(time.perf_counter() - self.start, 4))
+        return event
+
+    def failed(self, error: Exception) -> dict:
+        self.path = "error"
+        logger.error(f"Error in streaming response: {str(error)}")
+        logger.error(traceback.format_exc())
+        return {'error': str(error), 'status': 'error'}
+
+    def finish(self):
+        metrics.inc("requests_total", path=self.path)
+        metrics.observe("request_duration_seconds", time.perf_counter() - self.start, path=self.path)
+
+
+def answer_events(question: str, include_timings: bool = False):
+    """Answer a question, yielding the /api/chat events: cache lookup, routing, then the web or standard answer"""
+    turn = ChatTurn(question, include_timings)
+    try:
+        yield {'status': 'started'}
         
-        # Create the web search decision chain
-        web_search_decision_chain = (
-            web_search_decision_prompt
-            | llm
-            | StrOutputParser()
-        )
+        # Answer straight from the cache when this question was answered recently
+        cached = turn.lookup()
+        if cached:
+            yield from cached
+            return
         
-        # Define prompt template for regular questions
-        standard_prompt_template = """
-        You are Research Navigator, an AI research assistant designed to provide helpful, 
-        accurate, and thoughtful responses to research questions.
-
-        User question: "{question}"
+        # First, determine if we need to search the web
+        logger.info("Determining if web search is needed...")
+        yield turn.THINKING
+        speculation = turn.speculation()
+        with metrics.span("decision", turn.context.timings):
+            need_web_search = web_search_router.decide(
+                question, on_fallback=speculation.start if speculation else None
+            )
+        yield turn.decided(need_web_search, speculation)
         
-        Provide a well-structured and comprehensive answer.
-        """
+        if need_web_search:
+            # Stream progress events and answer tokens from web RAG as they are produced
+            for event in web_rag.query_stream(question, turn.context, speculation):
+                yield turn.web_event(event)
+        else:
+            with metrics.span("generation", turn.context.timings):
+                for token in standard_chain.stream({"question": question}):
+                    yield turn.token(token)
+        turn.store()
+        yield turn.complete()
+    except Exception as e:
+        yield turn.failed(e)
+    finally:
+        turn.finish()
 
-        standard_prompt = PromptTemplate.from_template(standard_prompt_template)
 
-        # Create the standard chain
-        standard_chain = (
-            standard_prompt
-            | llm
-            | StrOutputParser()
-        )
+async def aanswer_events(question: str, include_timings: bool = False, slots: asyncio.Semaphore = None):
+    """Async version of answer_events; slots optionally bounds the pipelines running at once"""
+    turn = ChatTurn(question, include_timings)
+    try:
+        yield {'status': 'started'}
+        
+        cached = await asyncio.to_thread(turn.lookup)
+        if cached:
+            for event in cached:
+                yield event
+            return
         
-        print("Gemini models and WebRAG initialized successfully!")
+        logger.info("Determining if web search is needed...")
+        yield turn.THINKING
+        async with slots or contextlib.nullcontext():
+            speculation = turn.speculation(asynchronous=True)
+            with metrics.span("decision", turn.context.timings):
+                need_web_search = await web_search_router.adecide(
+                    question, on_fallback=speculation.start if speculation else None
+                )
+            yield turn.decided(need_web_search, speculation)
+            
+            if need_web_search:
+                async for event in web_rag.aquery_stream(question, turn.context, speculation):
+                    yield turn.web_event(event)
+            else:
+                with metrics.span("generation", turn.context.timings):
+                    async for token in standard_chain.astream({"question": question}):
+                        yield turn.token(token)
+            await asyncio.to_thread(turn.store)
+        yield turn.complete()
     except Exception as e:
-        print(f"ERROR initializing Gemini model or WebRAG: {e}")
-        llm = None
-        web_rag = None
-        web_search_decision_chain = None
-        standard_chain = None
-else:
-    llm = None
-    web_rag = None
-    web_search_decision_chain = None
-    standard_chain = None
-    print("No API key found, models NOT initialized.")
+        yield turn.failed(e)
+    finally:
+        turn.finish()
 
-@app.route('/api/status', methods=['GET'])
-def get_status():
-    """Get the status of the server and model"""
-    status = {
+
+def server_status() -> dict:
+    """Status of the server, models and caches, shared by the Flask and ASGI apps"""
+    return {
         "server": "online",
+        "ready": components_ready(),
+        "initialization": dict(init_state),
         "model_initialized": llm is not None,
         "web_rag_initialized": web_rag is not None,
-        "api_key_available": api_key is not None
+        "api_key_available": api_key is not None,
+        "page_cache": web_rag.page_cache.stats() if web_rag else None,
+        "vectorstore": web_rag.index_stats() if web_rag else None,
+        "embeddings": web_rag.embeddings.stats() if web_rag else None,
+        "answer_cache": answer_cache.stats() if answer_cache else None,
+        "router": web_search_router.stats() if web_search_router else None,
+        "search": web_rag.searcher.stats() if web_rag else None,
+        "search_questions": web_rag.search_questions_cache.stats() if web_rag else None,
+        "prefetch": web_rag.prefetcher.stats() if web_rag else None,
+        "dns_cache": dns_cache.stats() if dns_cache.installed else None
     }
-    return jsonify(status)
+
+def render_metrics() -> str:
+    """Prometheus text exposition of the stage timings and cache counters, shared by the Flask and ASGI apps"""
+    collected = []
+    if web_rag:
+        page_cache = web_rag.page_cache.stats()
+        embeddings = web_rag.embeddings.stats()
+        index = web_rag.index_stats()
+        search = web_rag.searcher.stats()
+        search_questions = web_rag.search_questions_cache.stats()
+        prefetch = web_rag.prefetcher.stats()
+        collected += [
+            ("prefetch_questions_warmed_total", "counter", {}, prefetch["questions_warmed"]),
+            ("prefetch_searches_total", "counter", {}, prefetch["searches"]),
+            ("prefetch_deferred_total", "counter", {}, prefetch["deferred"]),
+            ("cache_hits_total", "counter", {"cache": "search_questions"}, search_questions["hits"]),
+            ("cache_misses_total", "counter", {"cache": "search_questions"}, search_questions["misses"]),
+            ("cache_hits_total", "counter", {"cache": "search"}, search["hits"]),
+            ("cache_misses_total", "counter", {"cache": "search"}, search["misses"]),
+            ("search_coalesced_total", "counter", {}, search["coalesced"]),
+            ("search_upstream_calls_total", "counter", {}, search["upstream_calls"]),
+            ("cache_hits_total", "counter", {"cache": "page"}, page_cache["hits"]),
+            ("cache_misses_total", "counter", {"cache": "page"}, page_cache["misses"]),
+            ("cache_hits_total", "counter", {"cache": "embedding"}, embeddings["hits"]),
+            ("cache_misses_total", "counter", {"cache": "embedding"}, embeddings["misses"]),
+            ("cache_hits_total", "counter", {"cache": "query_embedding"}, embeddings["query_hits"]),
+            ("cache_misses_total", "counter", {"cache": "query_embedding"}, embeddings["query_misses"]),
+            ("embedding_api_calls_total", "counter", {}, embeddings["api_calls"]),
+            ("cache_evictions_total", "counter", {"cache": "embedding"}, embeddings["evictions"]),
+            ("chunks_embedded_total", "counter", {}, index["chunks_embedded"]),
+            ("embeddings_saved_total", "counter", {}, index["embeddings_saved"]),
+            ("page_cache_bytes", "gauge", {}, page_cache["bytes"]),
+        ]
+    if dns_cache.installed:
+        stats = dns_cache.stats()
+        collected += [
+            ("cache_hits_total", "counter", {"cache": "dns"}, stats["hits"]),
+            ("cache_misses_total", "counter", {"cache": "dns"}, stats["misses"]),
+        ]
+    if answer_cache:
+        stats = answer_cache.stats()
+        collected += [
+            ("cache_hits_total", "counter", {"cache": "answer"}, stats["hits"]),
+            ("cache_misses_total", "counter", {"cache": "answer"}, stats["misses"]),
+        ]
+    if web_search_router:
+        stats = web_search_router.stats()
+        collected += [
+            ("router_decisions_total", "counter", {}, stats["decisions"]),
+            ("router_fallbacks_total", "counter", {}, stats["fallbacks"]),
+            ("router_fallback_errors_total", "counter", {}, stats["fallback_errors"]),
+        ]
+    return metrics.render(collected)
+
+@app.route('/api/status', methods=['GET'])
+def get_status():
+    """Get the status of the server and model"""
+    return jsonify(server_status())
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Expose latency histograms and counters in the Prometheus text format"""
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4')
 
 @app.route('/ping', methods=['GET'])
 def ping():
@@ -433,7 +3184,7 @@ def chat():
     """Handle user questions and stream AI responses with optional web search"""
     try:
         # Check if the models are initialized
-        if not llm or not web_rag:
+        if not ensure_components():
             if not api_key:
                 return jsonify({
                     "error": "Google API key not found. Please set the GOOGLE_API_KEY environment variable."
@@ -449,54 +3200,12 @@ def chat():
             return jsonify({"error": "Missing question parameter"}), 400
         
         question = data['question']
+        include_timings = bool(data.get('timings'))  # Opt-in per-request timing breakdown
         logger.info(f"Received question: {question}")
         
-        # Function to stream the response
-        def generate_response():
-            try:
-                # Send the response header for Server-Sent Events
-                yield 'data: ' + json.dumps({'status': 'started'}) + '\n\n'
-                
-                # First, determine if we need to search the web
-                logger.info("Determining if web search is needed...")
-                yield 'data: ' + json.dumps({'token': "Thinking if I need to search the web...\n"}) + '\n\n'
-                
-                need_web_search = web_search_decision_chain.invoke({"question": question}).strip().lower()
-                logger.info(f"Web search decision: {need_web_search}")
-                
-                if "yes" in need_web_search:
-                    # Use web search to answer the question
-                    yield 'data: ' + json.dumps({'token': "I need to search the web for this. One moment...\n\n"}) + '\n\n'
-                    
-                    # Get answer from web RAG
-                    answer = web_rag.query(question)
-                    
-                    # Stream the answer token by token
-                    for i in range(0, len(answer), 10):  # Send chunks of 10 chars for smoother streaming
-                        chunk = answer[i:i+10]
-                        yield 'data: ' + json.dumps({'token': chunk}) + '\n\n'
-                else:
-                    # Use standard model without web search
-                    yield 'data: ' + json.dumps({'token': "I can answer this without searching the web.\n\n"}) + '\n\n'
-                    
-                    # Stream tokens from standard chain
-                    for token in standard_chain.stream({"question": question}):
-                        yield 'data: ' + json.dumps({'token': token}) + '\n\n'
-                    
-                # Send completion event
-                yield 'data: ' + json.dumps({'status': 'complete'}) + '\n\n'
-                
-            except Exception as e:
-                logger.error(f"Error in streaming response: {str(e)}")
-                logger.error(traceback.format_exc())
-                yield 'data: ' + json.dumps({
-                    'error': str(e), 
-                    'status': 'error'
-                }) + '\n\n'
-        
         # Return a streaming response
         return Response(
-            stream_with_context(generate_response()),
+            stream_with_context(sse(event) for event in answer_events(question, include_timings)),
             content_type='text/event-stream',
             headers={
                 'Cache-Control': 'no-cache',
@@ -561,7 +3270,7 @@ def get_ssl_context():
 if __name__ == '__main__':
     print("Server starting...")
     print(f"API key {'found' if api_key else 'NOT FOUND'}")
-    print(f"Model {'initialized' if llm and web_rag else 'NOT initialized'}")
+    print(f"Model {'initialized' if components_ready() else 'initializing on first use' if api_key else 'NOT initialized'}")
     print(f"Allowed origins: {ALLOWED_ORIGINS}")
     
     # Get port from environment variable or use default
@@ -0,0 +1,126 @@
+"""
+Production ASGI server for Research Navigator.
+
+Serves the same routes as app.py (/api/chat, /api/chat/simple, /api/status,
+/api/metrics and /ping) but streams Server-Sent Events from coroutines, so an open
+stream does not hold a thread. Blocking work (DuckDuckGo searches, page loads, Chroma) still runs on
+WebRAG's bounded worker pools, which are shared by all requests.
+
+Run it with uvicorn, for example:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+Add --workers only with VECTORSTORE_BACKEND=quantized; the default Chroma store must stay in one process.
+See the README for the worker and concurrency settings.
+"""
+import asyncio
+import os
+from datetime import datetime
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+
+import app as backend  # Builds the models, caches and WebRAG shared with the Flask app
+
+# Number of chat pipelines that may run at once per process; further requests wait their turn
+CHAT_CONCURRENCY = int(os.getenv('CHAT_CONCURRENCY', 64))
+chat_slots = asyncio.Semaphore(CHAT_CONCURRENCY)
+
+logger = backend.logger
+
+
+async def get_status(request):
+    """Get the status of the server and model"""
+    return JSONResponse(backend.server_status())
+
+
+async def get_metrics(request):
+    """Expose latency histograms and counters in the Prometheus text format"""
+    return PlainTextResponse(backend.render_metrics(), media_type='text/plain; version=0.0.4')
+
+
+async def ping(request):
+    """Simple endpoint to check if the server is running"""
+    return JSONResponse({
+        "status": "success",
+        "message": "pong",
+        "timestamp": datetime.now().isoformat()
+    })
+
+
+async def generate_response(question: str, include_timings: bool = False):
+    """Stream the answer to a question as Server-Sent Events"""
+    async for event in backend.aanswer_events(question, include_timings, slots=chat_slots):
+        yield backend.sse(event)
+
+
+async def chat(request):
+    """Handle user questions and stream AI responses with optional web search"""
+    # Build the models on first use, if the background warm-up hasn't finished yet
+    if not await asyncio.to_thread(backend.ensure_components):
+        if not backend.api_key:
+            return JSONResponse({
+                "error": "Google API key not found. Please set the GOOGLE_API_KEY environment variable."
+            }, status_code=500)
+        return JSONResponse({
+            "error": "AI models not initialized. Check server logs for details."
+        }, status_code=500)
+
+    # Get the question from the request
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not data or 'question' not in data:
+        return JSONResponse({"error": "Missing question parameter"}, status_code=400)
+
+    question = data['question']
+    include_timings = bool(data.get('timings'))  # Opt-in per-request timing breakdown
+    logger.info(f"Received question: {question}")
+
+    return StreamingResponse(
+        generate_response(question, include_timings),
+        media_type='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+
+async def simple_chat(request):
+    """Handle user questions with a simple response"""
+    data = await request.json()
+    question = data.get('question', '')
+
+    response = f"You asked: {question}\n\nThis is a simple response from the Research Navigator. In the future, this will be connected to an AI research assistant."
+
+    return JSONResponse({
+        "status": "complete",
+        "token": response
+    })
+
+
+app = Starlette(
+    routes=[
+        Route('/api/status', get_status, methods=['GET']),
+        Route('/api/metrics', get_metrics, methods=['GET']),
+        Route('/ping', ping, methods=['GET']),
+        Route('/api/chat', chat, methods=['POST']),
+        Route('/api/chat/simple', simple_chat, methods=['POST']),
+    ],
+    middleware=[
+        # Same CORS policy as the Flask app, preflight requests included
+        Middleware(
+            CORSMiddleware,
+            allow_origins=backend.ALLOWED_ORIGINS,
+            allow_credentials=True,
+            allow_methods=['GET', 'POST'],
+            allow_headers=['Content-Type', 'Authorization'],
+            expose_headers=['Content-Type', 'X-CSRFToken']
+        )
+    ]
+)
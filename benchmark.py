@@ -0,0 +1,519 @@
+"""
+Offline benchmark for the Research Navigator backend.
+
+Runs the web search pipeline with local stand-ins for everything that normally needs
+the network: a fake DDGS search client, a local HTTP server serving fixture pages,
+and deterministic fake LLM and embedding models with configurable latency. Reports
+per-stage timings, end-to-end p50/p95/p99, time-to-first-token and throughput.
+
+Examples:
+
+    python benchmark.py --requests 50 --concurrency 8
+    python benchmark.py --target flask --requests 200 --concurrency 32
+    python benchmark.py --target asgi --concurrency 100 --max-p95 5 --json bench.json
+    python benchmark.py --target startup --startup-runs 5 --max-startup 1
+
+Targets:
+    pipeline  calls WebRAG.query_stream directly from N threads
+    flask     N concurrent SSE clients against the Flask app in app.py
+    asgi      N concurrent SSE clients against the ASGI app in asgi.py (needs uvicorn)
+    startup   cold starts in fresh processes: importing app.py, the first /ping answered by
+              uvicorn and, when GOOGLE_API_KEY is set, the time until /api/status reports ready
+
+Exits with status 1 when a --max-* threshold is exceeded, so it can gate CI.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Keep every on-disk store in a scratch directory and stop app.py from building the
+# real Gemini clients; this has to happen before app is imported
+SCRATCH_DIR = tempfile.mkdtemp(prefix="research-navigator-bench-")
+API_KEY = os.environ.get("GOOGLE_API_KEY", "")  # Only the startup target uses the real key, to time readiness
+os.environ["GOOGLE_API_KEY"] = ""
+os.environ["PAGE_CACHE_PATH"] = os.path.join(SCRATCH_DIR, "page_cache.sqlite3")
+os.environ["EMBEDDING_CACHE_PATH"] = os.path.join(SCRATCH_DIR, "embedding_cache.sqlite3")
+os.environ["VECTORSTORE_PATH"] = os.path.join(SCRATCH_DIR, "web_chroma_db")
+os.environ["QUERY_LOG_PATH"] = os.path.join(SCRATCH_DIR, "query_log.sqlite3")
+os.environ["QUANTIZED_INDEX_PATH"] = os.path.join(SCRATCH_DIR, "vector_index")
+
+import requests
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+import app as backend
+
+STAGES = ["generate_questions", "search", "load_and_index", "retrieve", "first_token", "generate"]
+
+WORDS = (
+    "research navigator benchmark fixture article measures latency throughput pipeline search "
+    "engine result page content model token answer source citation context chunk vector index "
+    "retrieval embedding cache network server client stream event question topic analysis report"
+).split()
+
+
+def fixture_text(seed: str, words: int) -> str:
+    """Deterministic pseudo-text for a seed"""
+    digest = hashlib.sha256(seed.encode("utf-8")).digest()
+    out = []
+    for i in range(words):
+        out.append(WORDS[(digest[i % len(digest)] + i * 7) % len(WORDS)])
+        if i % 15 == 14:
+            out[-1] += "."
+    return " ".join(out)
+
+
+class FakeLLM(LLM):
+    """Deterministic stand-in for the Gemini chat model"""
+    first_token_latency: float = 0.5
+    token_latency: float = 0.01
+    sub_queries: int = 3
+    answer_words: int = 150
+
+    @property
+    def _llm_type(self) -> str:
+        return "benchmark-fake"
+
+    def _respond(self, prompt: str) -> str:
+        if "search queries" in prompt:
+            match = re.search(r'Original question: "(.*)"', prompt)
+            question = match.group(1) if match else "topic"
+            aspects = ["overview", "latest developments", "expert analysis", "statistics", "history"]
+            return json.dumps([f"{question} {aspects[i % len(aspects)]}" for i in range(self.sub_queries)])
+        if 'answer with only "Yes"' in prompt:
+            return "Yes"
+        return fixture_text(prompt[-200:], self.answer_words)
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs) -> str:
+        text = self._respond(prompt)
+        time.sleep(self.first_token_latency + self.token_latency * len(text.split()))
+        return text
+
+    def _stream(self, prompt, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.first_token_latency)
+        for word in self._respond(prompt).split():
+            yield GenerationChunk(text=word + " ")
+            time.sleep(self.token_latency)
+
+    async def _acall(self, prompt, stop=None, run_manager=None, **kwargs) -> str:
+        text = self._respond(prompt)
+        await asyncio.sleep(self.first_token_latency + self.token_latency * len(text.split()))
+        return text
+
+    async def _astream(self, prompt, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.first_token_latency)
+        for word in self._respond(prompt).split():
+            yield GenerationChunk(text=word + " ")
+            await asyncio.sleep(self.token_latency)
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic bag-of-words embeddings with a fixed latency per call"""
+    def __init__(self, latency: float, dimensions: int = 256):
+        self.latency = latency
+        self.dimensions = dimensions
+        self.calls = 0
+
+    def _embed(self, text: str):
+        vector = [0.0] * self.dimensions
+        for word in text.lower().split():
+            vector[int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16) % self.dimensions] += 1.0
+        norm = sum(x * x for x in vector) ** 0.5 or 1.0
+        return [x / norm for x in vector]
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        self.calls += 1
+        time.sleep(self.latency)
+        return self._embed(text)
+
+
+class FakeSearch:
+    """Stand-in for DDGS that returns pages of the local fixture server"""
+    def __init__(self, base_url: str, latency: float, pages: int):
+        self.base_url = base_url
+        self.latency = latency
+        self.pages = pages
+        self.calls = 0
+
+    def text(self, query, region=None, safesearch=None, max_results=3):
+        self.calls += 1
+        time.sleep(self.latency)
+        # Popular pages overlap between queries, like real search results do
+        start = int(hashlib.md5(query.encode("utf-8")).hexdigest(), 16) % self.pages
+        return [
+            {
+                "title": f"Fixture page {(start + i) % self.pages}",
+                "href": f"{self.base_url}/page/{(start + i) % self.pages}",
+                "body": fixture_text(f"snippet-{start + i}", 20)
+            }
+            for i in range(max_results)
+        ]
+
+
+def start_fixture_server(latency: float, page_kb: int):
+    """Serve deterministic HTML pages on a free localhost port, returning (server, base_url)"""
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Keep-alive, like real sites
+
+        def do_GET(self):
+            time.sleep(latency)
+            words = max(50, page_kb * 1024 // 8)
+            body = (
+                f"<html lang=\"en\"><head><title>Fixture {self.path}</title>"
+                f"<script>var tracking = '{'x' * 512}';</script></head><body>"
+                f"<nav>Home News Sports Weather About Contact</nav>"
+                f"<article><h1>Fixture {self.path}</h1><p>{fixture_text(self.path, words)}</p></article>"
+                f"<footer>Copyright fixture</footer></body></html>"
+            ).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def free_port() -> int:
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_app_server(target: str):
+    """Run the Flask or ASGI app on a free localhost port, returning its base URL"""
+    if target == "flask":
+        from werkzeug.serving import make_server
+        server = make_server("127.0.0.1", 0, backend.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{server.server_port}"
+
+    import uvicorn
+    import asgi
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(asgi.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+class Timeline:
+    """Timestamps of the events of one request, relative to when it was sent"""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.marks = {}
+        self.answering = False
+        self.error = None
+
+    def record(self, event: dict):
+        now = time.perf_counter() - self.start
+        stage = event.get("stage")
+        if stage:
+            # Searches and page loads finish once per sub-query; keep the last one
+            self.marks[stage] = now
+        if stage == "retrieval_done" or event.get("status") == "cache_hit":
+            self.answering = True
+        if "token" in event and self.answering:
+            self.marks.setdefault("first_token", now)
+        if event.get("status") == "error":
+            self.error = event.get("error")
+
+    def finish(self):
+        self.marks["end"] = time.perf_counter() - self.start
+
+    def stages(self) -> dict:
+        """Duration of each pipeline stage, for the stages this request went through"""
+        order = [
+            ("generate_questions", "questions_generated"),
+            ("search", "search_done"),
+            ("load_and_index", "pages_loaded"),
+            ("retrieve", "retrieval_done"),
+            ("first_token", "first_token"),
+            ("generate", "end"),
+        ]
+        durations = {}
+        previous = 0.0
+        for name, mark in order:
+            if mark in self.marks:
+                durations[name] = self.marks[mark] - previous
+                previous = self.marks[mark]
+        return durations
+
+
+def run_pipeline_request(question: str) -> Timeline:
+    timeline = Timeline()
+    for event in backend.web_rag.query_stream(question):
+        timeline.record(event)
+    timeline.finish()
+    return timeline
+
+
+def run_sse_request(base_url: str, question: str) -> Timeline:
+    timeline = Timeline()
+    try:
+        with requests.post(f"{base_url}/api/chat", json={"question": question}, stream=True, timeout=120) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if line and line.startswith("data: "):
+                    timeline.record(json.loads(line[len("data: "):]))
+    except Exception as e:
+        timeline.error = str(e)
+    timeline.finish()
+    return timeline
+
+
+def percentile(values, p: float) -> float:
+    """Linearly interpolated percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def summarize(values) -> dict:
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "mean": sum(values) / len(values) if values else 0.0
+    }
+
+
+def run(args) -> dict:
+    fixture_server, fixture_url = start_fixture_server(args.page_latency, args.page_kb)
+
+    llm = FakeLLM(
+        first_token_latency=args.llm_latency,
+        token_latency=args.token_latency,
+        sub_queries=args.sub_queries
+    )
+    embeddings = FakeEmbeddings(args.embedding_latency)
+    search = FakeSearch(fixture_url, args.search_latency, args.pages)
+    backend.VECTORSTORE_BACKEND = args.vector_backend
+    # The DuckDuckGo budget would otherwise dominate the timings; lower these to measure it
+    backend.SEARCH_RATE_PER_SECOND = args.search_rate
+    backend.SEARCH_BURST = args.search_burst
+    backend.init_components(llm, backend.WebRAG(llm=llm, embeddings=embeddings, search=search))
+
+    if args.target == "pipeline":
+        run_request = run_pipeline_request
+    else:
+        base_url = start_app_server(args.target)
+        run_request = lambda question: run_sse_request(base_url, question)
+
+    # Recency wording keeps every question on the web search path
+    questions = [f"What is the latest news about topic {i % args.distinct}?" for i in range(args.requests)]
+    timelines = []
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if not questions:
+                    return
+                question = questions.pop(0)
+            timeline = run_request(question)
+            with lock:
+                timelines.append(timeline)
+
+    wall_start = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    wall = time.perf_counter() - wall_start
+    fixture_server.shutdown()
+
+    ok = [timeline for timeline in timelines if not timeline.error]
+    return {
+        "target": args.target,
+        "requests": len(timelines),
+        "errors": len(timelines) - len(ok),
+        "concurrency": args.concurrency,
+        "wall_seconds": wall,
+        "throughput_rps": len(ok) / wall if wall else 0.0,
+        "end_to_end": summarize([timeline.marks["end"] for timeline in ok]),
+        "time_to_first_token": summarize([timeline.marks["first_token"] for timeline in ok if "first_token" in timeline.marks]),
+        "stages": {
+            stage: summarize([timeline.stages()[stage] for timeline in ok if stage in timeline.stages()])
+            for stage in STAGES
+        },
+        "upstream_calls": {
+            "search": search.calls,
+            "embedding": embeddings.calls
+        }
+    }
+
+
+def wait_until(check, start: float, timeout: float) -> float:
+    """Poll check() until it returns true, returning the seconds elapsed since start"""
+    while time.perf_counter() - start < timeout:
+        try:
+            if check():
+                return time.perf_counter() - start
+        except requests.RequestException:
+            pass
+        time.sleep(0.02)
+    raise RuntimeError(f"Timed out after {timeout}s")
+
+
+def server_ready(base_url: str) -> bool:
+    status = requests.get(base_url + "/api/status", timeout=1).json()
+    if status["initialization"]["status"] == "failed":
+        raise RuntimeError(f"Initialization failed: {status['initialization']['error']}")
+    return status["ready"]
+
+
+def run_startup(args) -> dict:
+    """Time cold starts of fresh processes"""
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, GOOGLE_API_KEY=API_KEY)
+    imports, pings, readies = [], [], []
+    for _ in range(args.startup_runs):
+        # Import alone, without the background model warm-up
+        output = subprocess.run(
+            [sys.executable, "-c", "import time; start = time.perf_counter(); import app; print(time.perf_counter() - start)"],
+            cwd=app_dir, env=dict(env, EAGER_INIT="false"), capture_output=True, text=True, check=True
+        )
+        imports.append(float(output.stdout.strip().splitlines()[-1]))
+
+        # Full server start, as a new replica would do it
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        start = time.perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "asgi:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+            cwd=app_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            pings.append(wait_until(lambda: requests.get(base_url + "/ping", timeout=1).ok, start, args.startup_timeout))
+            if API_KEY:
+                readies.append(wait_until(lambda: server_ready(base_url), start, args.startup_timeout))
+        finally:
+            server.terminate()
+            server.wait()
+
+    return {
+        "target": "startup",
+        "runs": args.startup_runs,
+        "import": summarize(imports),
+        "first_ping": summarize(pings),
+        "ready": summarize(readies) if readies else None
+    }
+
+
+def print_startup_report(report: dict):
+    print(f"Target: startup  runs: {report['runs']}")
+    print()
+    print(f"{'':<22}{'p50':>10}{'p95':>10}{'p99':>10}{'mean':>10}")
+    rows = [("import app.py", report["import"]), ("first /ping", report["first_ping"])]
+    if report["ready"]:
+        rows.append(("ready", report["ready"]))
+    for name, stats in rows:
+        print(f"{name:<22}" + "".join(f"{stats[key]:>10.3f}" for key in ("p50", "p95", "p99", "mean")))
+    if not report["ready"]:
+        print("(set GOOGLE_API_KEY to also time readiness)")
+
+
+def print_report(report: dict):
+    print(f"Target: {report['target']}  requests: {report['requests']}  errors: {report['errors']}  "
+          f"concurrency: {report['concurrency']}")
+    print(f"Wall time: {report['wall_seconds']:.2f}s  throughput: {report['throughput_rps']:.2f} req/s")
+    print(f"Upstream calls: {report['upstream_calls']['search']} searches, "
+          f"{report['upstream_calls']['embedding']} embedding requests")
+    print()
+    print(f"{'':<22}{'p50':>10}{'p95':>10}{'p99':>10}{'mean':>10}")
+    rows = [("end to end", report["end_to_end"]), ("time to first token", report["time_to_first_token"])]
+    rows += [(f"  {stage}", report["stages"][stage]) for stage in STAGES]
+    for name, stats in rows:
+        print(f"{name:<22}" + "".join(f"{stats[key]:>10.3f}" for key in ("p50", "p95", "p99", "mean")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the Research Navigator backend")
+    parser.add_argument("--target", choices=["pipeline", "flask", "asgi", "startup"], default="pipeline")
+    parser.add_argument("--requests", type=int, default=20, help="Total number of questions")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent clients")
+    parser.add_argument("--distinct", type=int, default=None, help="Distinct questions (default: all distinct)")
+    parser.add_argument("--sub-queries", type=int, default=3, help="Search questions the fake LLM generates")
+    parser.add_argument("--pages", type=int, default=200, help="Fixture pages the fake search chooses from")
+    parser.add_argument("--page-kb", type=int, default=20, help="Approximate size of each fixture page")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds before the first LLM token")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="Seconds between LLM tokens")
+    parser.add_argument("--embedding-latency", type=float, default=0.1, help="Seconds per embedding request")
+    parser.add_argument("--search-latency", type=float, default=0.3, help="Seconds per search")
+    parser.add_argument("--page-latency", type=float, default=0.2, help="Seconds per page download")
+    parser.add_argument("--search-rate", type=float, default=1000.0,
+                        help="Searches per second allowed by the shared rate limiter (the server default is 1)")
+    parser.add_argument("--search-burst", type=int, default=1000,
+                        help="Searches allowed back to back by the shared rate limiter (the server default is 5)")
+    parser.add_argument("--vector-backend", choices=["chroma", "quantized"], default="chroma",
+                        help="Vector index behind WebRAG.vectorstore")
+    parser.add_argument("--startup-runs", type=int, default=5, help="Cold starts to time with --target startup")
+    parser.add_argument("--startup-timeout", type=float, default=120, help="Seconds to wait for a cold start")
+    parser.add_argument("--json", help="Also write the report as JSON to this file")
+    parser.add_argument("--max-p95", type=float, help="Fail if end-to-end p95 exceeds this many seconds")
+    parser.add_argument("--max-ttft-p95", type=float, help="Fail if time-to-first-token p95 exceeds this many seconds")
+    parser.add_argument("--max-startup", type=float, help="Fail if the first /ping p95 exceeds this many seconds")
+    args = parser.parse_args()
+    args.distinct = args.distinct or args.requests
+
+    if args.target == "startup":
+        report = run_startup(args)
+        print_startup_report(report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+        if args.max_startup is not None and report["first_ping"]["p95"] > args.max_startup:
+            print(f"FAIL: first /ping p95 {report['first_ping']['p95']:.3f}s > {args.max_startup}s")
+            sys.exit(1)
+        sys.exit(0)
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    failed = report["errors"] > 0
+    if args.max_p95 is not None and report["end_to_end"]["p95"] > args.max_p95:
+        print(f"FAIL: end-to-end p95 {report['end_to_end']['p95']:.3f}s > {args.max_p95}s")
+        failed = True
+    if args.max_ttft_p95 is not None and report["time_to_first_token"]["p95"] > args.max_ttft_p95:
+        print(f"FAIL: time-to-first-token p95 {report['time_to_first_token']['p95']:.3f}s > {args.max_ttft_p95}s")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
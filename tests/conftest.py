@@ -0,0 +1,57 @@
+"""
+Shared fixtures: a WebRAG wired to the offline stand-ins of benchmark.py.
+
+Importing benchmark keeps every on-disk store in a scratch directory and stops app.py
+from building the real Gemini clients.
+"""
+import hashlib
+import os
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark  # noqa: E402
+from benchmark import FakeEmbeddings, FakeLLM, FakeSearch, backend, start_fixture_server  # noqa: E402
+
+
+class TopicSearch(FakeSearch):
+    """Search results that only ever point at pages of the query's own topic.
+
+    Questions are phrased "... topic N ...", so a URL of another topic in an answer means
+    results leaked between concurrent requests.
+    """
+    def text(self, query, region=None, safesearch=None, max_results=3):
+        self.calls += 1
+        topic = re.search(r"topic (\d+)", query).group(1)
+        digest = hashlib.md5(query.encode("utf-8")).hexdigest()[:8]
+        return [
+            {
+                "title": f"Topic {topic} page {digest}-{i}",
+                "href": f"{self.base_url}/topic-{topic}/{digest}/{i}",
+                "body": benchmark.fixture_text(f"snippet-{topic}-{digest}-{i}", 20)
+            }
+            for i in range(max_results)
+        ]
+
+
+@pytest.fixture(scope="session")
+def fixture_url():
+    server, base_url = start_fixture_server(latency=0.02, page_kb=2)
+    yield base_url
+    server.shutdown()
+
+
+@pytest.fixture(params=["chroma", "quantized"])
+def rag(request, fixture_url, monkeypatch):
+    """A WebRAG on the fake models and topic-scoped search, for each vector backend"""
+    if request.param == "chroma":
+        pytest.importorskip("langchain_chroma")
+    monkeypatch.setattr(backend, "VECTORSTORE_BACKEND", request.param)
+    # The tests search far faster than the DuckDuckGo budget allows
+    monkeypatch.setattr(backend, "SEARCH_RATE_PER_SECOND", 1000.0)
+    monkeypatch.setattr(backend, "SEARCH_BURST", 1000)
+    llm = FakeLLM(first_token_latency=0.01, token_latency=0.0, sub_queries=3, answer_words=40)
+    return backend.WebRAG(llm=llm, embeddings=FakeEmbeddings(latency=0.01), search=TopicSearch(fixture_url, 0.01, 0))
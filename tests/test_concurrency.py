@@ -0,0 +1,73 @@
+"""
+Concurrent queries must never see each other's sources or context.
+
+Every question gets search results on URLs of its own topic only, so any URL of another
+topic in an answer, its QueryContext or its retrieved chunks is a leak between requests.
+"""
+import asyncio
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark import backend
+
+QUESTIONS = [f"What is the latest news about topic {i}?" for i in range(8)]
+
+SOURCE_LINK = re.compile(r"^- \[.*\]\((.+)\)$", re.MULTILINE)
+
+
+def answer_sources(answer: str):
+    """URLs listed in the Sources section of an answer"""
+    assert "**Sources:**" in answer
+    return SOURCE_LINK.findall(answer.split("**Sources:**", 1)[1])
+
+
+def assert_isolated(question: str, answer: str, context: "backend.QueryContext", base_url: str):
+    topic = re.search(r"topic (\d+)", question).group(1)
+    prefix = f"{base_url}/topic-{topic}/"
+    
+    assert context.sources, f"No sources for {question!r}"
+    assert all(url.startswith(prefix) for url in context.source_urls()), context.source_urls()
+    assert answer_sources(answer) == context.source_urls()
+    
+    assert context.docs, f"No context retrieved for {question!r}"
+    assert all(doc.metadata["source"].startswith(prefix) for doc in context.docs)
+
+
+def run_query(rag, question: str):
+    context = backend.QueryContext(question)
+    answer = "".join(event.get("token", "") for event in rag.query_stream(question, context))
+    return answer, context
+
+
+async def arun_query(rag, question: str):
+    context = backend.QueryContext(question)
+    answer = ""
+    async for event in rag.aquery_stream(question, context):
+        answer += event.get("token", "")
+    return answer, context
+
+
+def test_concurrent_query_stream_keeps_sources_apart(rag, fixture_url):
+    with ThreadPoolExecutor(max_workers=len(QUESTIONS)) as pool:
+        results = list(pool.map(lambda question: run_query(rag, question), QUESTIONS))
+    
+    for question, (answer, context) in zip(QUESTIONS, results):
+        assert_isolated(question, answer, context, fixture_url)
+
+
+def test_concurrent_aquery_stream_keeps_sources_apart(rag, fixture_url):
+    async def run_all():
+        return await asyncio.gather(*(arun_query(rag, question) for question in QUESTIONS))
+    
+    for question, (answer, context) in zip(QUESTIONS, asyncio.run(run_all())):
+        assert_isolated(question, answer, context, fixture_url)
+
+
+def test_repeated_questions_run_concurrently_with_shared_caches(rag, fixture_url):
+    # The same questions twice at once exercise the coalesced searches and shared page cache
+    questions = QUESTIONS[:4] * 2
+    with ThreadPoolExecutor(max_workers=len(questions)) as pool:
+        results = list(pool.map(lambda question: run_query(rag, question), questions))
+    
+    for question, (answer, context) in zip(questions, results):
+        assert_isolated(question, answer, context, fixture_url)
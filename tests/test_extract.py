@@ -0,0 +1,36 @@
+"""
+extract_main_text drops page chrome but never the element holding the article.
+"""
+import pytest
+
+from benchmark import backend
+
+BeautifulSoup = pytest.importorskip("bs4").BeautifulSoup
+
+ARTICLE = "Real article text. " * 40
+
+
+def extract(html: str) -> str:
+    return backend.extract_main_text(BeautifulSoup(html, "html.parser"))
+
+
+def test_compound_theme_classes_keep_the_body():
+    text = extract(
+        '<html><body class="header-full-width has-sidebar page-with-comments menu-open">'
+        '<div class="site-header">Logo</div><div id="nav">Home | About</div>'
+        f'<div class="content sidebar"><article>{ARTICLE}<div class="share">Share</div></article></div>'
+        '<div class="sidebar">Recent posts</div></body></html>'
+    )
+    assert text.startswith("Real article text.")
+    assert "Logo" not in text and "Recent posts" not in text and "Share" not in text
+
+
+def test_page_wide_form_is_kept():
+    text = extract(f'<html><body><form id="aspnetForm"><div><nav>Menu</nav><main>{ARTICLE}</main></div></form></body></html>')
+    assert text.startswith("Real article text.")
+    assert "Menu" not in text
+
+
+def test_header_and_form_chrome_are_removed():
+    text = extract(f'<html><body><header>Site name</header><form>Search</form><article>{ARTICLE}</article></body></html>')
+    assert "Site name" not in text and "Search" not in text
@@ -0,0 +1,78 @@
+"""
+Concurrent indexing of the same page must not report chunks as stored before they are.
+
+The second of two calls on the same chunks waits for the first one, and embeds them itself
+when the first one failed.
+"""
+import threading
+import time
+import uuid
+
+from benchmark import FakeEmbeddings, backend
+
+from langchain_core.documents import Document
+
+
+class FlakyEmbeddings(FakeEmbeddings):
+    """Slow embeddings whose first call fails once its latency has passed"""
+    def __init__(self, latency: float, fail_first: bool):
+        super().__init__(latency)
+        self.fail_first = fail_first
+
+    def embed_documents(self, texts):
+        vectors = super().embed_documents(texts)
+        if self.fail_first and self.calls == 1:
+            raise RuntimeError("embedding API unavailable")
+        return vectors
+
+
+def page_url() -> str:
+    # The vectorstore and embedding cache outlive a test, so every test indexes a page of its own
+    return f"http://fixture.test/{uuid.uuid4().hex}"
+
+
+def page_splits(url: str):
+    return [Document(page_content=f"Chunk {i} of {url}", metadata={"source": url}) for i in range(5)]
+
+
+def stored_chunks(rag, url: str) -> int:
+    return len(rag.vectorstore.existing_ids([backend.document_id(doc) for doc in page_splits(url)]))
+
+
+def index_twice(rag, url: str):
+    """Index the same page from two threads, the second starting while the first embeds"""
+    results = {}
+
+    def index(name):
+        started = time.monotonic()
+        results[name] = (rag.index_documents(page_splits(url), deadline=time.monotonic() + 10),
+                         time.monotonic() - started)
+
+    first = threading.Thread(target=index, args=("first",))
+    first.start()
+    time.sleep(0.2)
+    index("second")
+    first.join()
+    return results
+
+
+def test_concurrent_indexing_waits_for_the_other_worker(rag):
+    rag.embeddings.embeddings = FlakyEmbeddings(latency=0.6, fail_first=False)
+    url = page_url()
+    results = index_twice(rag, url)
+
+    assert results["first"][0] == 5
+    stored, seconds = results["second"]
+    assert stored == 5
+    assert seconds > 0.2  # It waited for the first call instead of returning at once
+    assert stored_chunks(rag, url) == 5
+
+
+def test_concurrent_indexing_retries_after_the_other_worker_failed(rag):
+    rag.embeddings.embeddings = FlakyEmbeddings(latency=0.6, fail_first=True)
+    url = page_url()
+    results = index_twice(rag, url)
+
+    assert results["first"][0] == 0
+    assert results["second"][0] == 5
+    assert stored_chunks(rag, url) == 5
@@ -0,0 +1,33 @@
+"""
+parse_search_questions reads the model's search questions from a JSON array,
+or from a numbered or bulleted list when there is no usable array.
+"""
+from benchmark import backend
+
+
+def test_json_array():
+    assert backend.parse_search_questions('["first query", "second  query"]') == ["first query", "second query"]
+
+
+def test_json_array_with_trailing_prose():
+    result = '["a", "b"]\nThese cover the main aspects of the question.'
+    assert backend.parse_search_questions(result) == ["a", "b"]
+
+
+def test_json_array_followed_by_brackets_in_prose():
+    result = '["a", "b"]\nNote: covers [history]'
+    assert backend.parse_search_questions(result) == ["a", "b"]
+
+
+def test_brackets_in_prose_before_the_array():
+    result = 'Here are the queries [as requested]:\n```json\n["x y", "z"]\n```'
+    assert backend.parse_search_questions(result) == ["x y", "z"]
+
+
+def test_numbered_list_fallback():
+    result = "Search queries:\n1. \"first query\"\n2) second query\n- third query about 2024"
+    assert backend.parse_search_questions(result) == ["first query", "second query", "third query about 2024"]
+
+
+def test_no_questions():
+    assert backend.parse_search_questions("I can't help with that.") == []